@@ -0,0 +1,41 @@
+"""Compare latency and throughput of the cell classifier backends.
+
+Usage: python benchmark_classifier.py [--backends tensorflow onnx tflite_int8] [--threads N]
+"""
+import argparse
+import asyncio
+import json
+import os
+
+from models.efficientnet_model import EfficientNetB0Model
+from models.classifier_backends import benchmark_backend
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--backends", nargs="+", default=["tensorflow", "onnx"])
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=[1, 16, 64, 256])
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--threads", type=int, default=0, help="ONNX Runtime intra-op threads (0 = all cores)")
+    args = parser.parse_args()
+
+    results = []
+    for backend in args.backends:
+        model = EfficientNetB0Model(artifact_dir=os.getenv("MODEL_CACHE_DIR", "model_cache"))
+        await model.load_model()
+
+        # int8 calibration needs stored uploads; benchmark only an existing artifact
+        if not await model.select_backend(backend, intra_op_threads=args.threads,
+                                          calibration_images=lambda: asyncio.sleep(0, [])):
+            print(f"Skipping {backend}: backend unavailable")
+            continue
+
+        results.extend(benchmark_backend(model.classifier, args.batch_sizes, args.repeats))
+
+    print(f"{'backend':<12} {'batch':>6} {'latency ms':>11} {'patches/s':>10}")
+    for row in results:
+        print(f"{row['backend']:<12} {row['batch_size']:>6} {row['latency_ms']:>11.1f} {row['patches_per_sec']:>10.1f}")
+
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    asyncio.run(main())
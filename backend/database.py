@@ -1,6 +1,7 @@
 import asyncio
 import json
 import sqlite3
+import time
 from datetime import datetime
 from typing import Dict, List, Optional
 import logging
@@ -85,10 +86,39 @@ class Database:
         )
         """
         
+        create_result_cache_table = """
+        CREATE TABLE IF NOT EXISTS result_cache (
+            cache_key TEXT PRIMARY KEY,
+            analysis_id TEXT NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (analysis_id) REFERENCES analysis_results (analysis_id)
+        )
+        """
+        
+        create_cache_counters_table = """
+        CREATE TABLE IF NOT EXISTS cache_counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        )
+        """
+        
+        create_explanation_cache_table = """
+        CREATE TABLE IF NOT EXISTS explanation_cache (
+            prompt_key TEXT PRIMARY KEY,
+            explanation TEXT NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            last_used REAL NOT NULL
+        )
+        """
+        
         cursor = self.connection.cursor()
         cursor.execute(create_analysis_table)
         cursor.execute(create_follow_up_table)
         cursor.execute(create_user_sessions_table)
+        cursor.execute(create_result_cache_table)
+        cursor.execute(create_cache_counters_table)
+        cursor.execute(create_explanation_cache_table)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_explanation_cache_last_used ON explanation_cache (last_used)")
         self.connection.commit()
     
     async def save_analysis_result(self, result: AnalysisResult) -> bool:
@@ -198,7 +228,7 @@ class Database:
             
             query = """
             SELECT question, answer, timestamp FROM follow_up_questions 
-            WHERE analysis_id = ? ORDER BY timestamp ASC
+            WHERE analysis_id = ? ORDER BY timestamp ASC, id ASC
             """
             
             cursor.execute(query, (analysis_id,))
@@ -217,6 +247,114 @@ class Database:
             logger.error(f"Error getting follow-up questions: {str(e)}")
             return []
     
+    async def get_cached_analysis_id(self, cache_key: str) -> Optional[str]:
+        """Get the analysis that produced the cached result for a cache key"""
+        try:
+            cursor = self.connection.cursor()
+            
+            query = """
+            SELECT c.analysis_id FROM result_cache c
+            JOIN analysis_results r ON r.analysis_id = c.analysis_id
+            WHERE c.cache_key = ?
+            """
+            
+            cursor.execute(query, (cache_key,))
+            row = cursor.fetchone()
+            
+            return row['analysis_id'] if row else None
+            
+        except Exception as e:
+            logger.error(f"Error reading result cache: {str(e)}")
+            return None
+    
+    async def save_cached_analysis_id(self, cache_key: str, analysis_id: str) -> bool:
+        """Record the analysis whose result answers a cache key"""
+        try:
+            cursor = self.connection.cursor()
+            
+            insert_query = """
+            INSERT OR REPLACE INTO result_cache (cache_key, analysis_id) VALUES (?, ?)
+            """
+            
+            cursor.execute(insert_query, (cache_key, analysis_id))
+            self.connection.commit()
+            return True
+            
+        except Exception as e:
+            logger.error(f"Error saving result cache entry: {str(e)}")
+            return False
+    
+    async def get_cached_explanation(self, prompt_key: str) -> Optional[str]:
+        """Get a cached explanation and mark it as recently used"""
+        try:
+            cursor = self.connection.cursor()
+            
+            cursor.execute("SELECT explanation FROM explanation_cache WHERE prompt_key = ?", (prompt_key,))
+            row = cursor.fetchone()
+            if not row:
+                return None
+            
+            cursor.execute(
+                "UPDATE explanation_cache SET last_used = ? WHERE prompt_key = ?",
+                (time.time(), prompt_key)
+            )
+            self.connection.commit()
+            
+            return row['explanation']
+            
+        except Exception as e:
+            logger.error(f"Error reading explanation cache: {str(e)}")
+            return None
+    
+    async def save_cached_explanation(self, prompt_key: str, explanation: str, max_entries: int) -> bool:
+        """Cache an explanation, evicting the least recently used entries beyond `max_entries`"""
+        try:
+            cursor = self.connection.cursor()
+            
+            cursor.execute("""
+                INSERT OR REPLACE INTO explanation_cache (prompt_key, explanation, last_used)
+                VALUES (?, ?, ?)
+            """, (prompt_key, explanation, time.time()))
+            
+            cursor.execute("""
+                DELETE FROM explanation_cache WHERE prompt_key IN (
+                    SELECT prompt_key FROM explanation_cache
+                    ORDER BY last_used DESC LIMIT -1 OFFSET ?
+                )
+            """, (max_entries,))
+            
+            self.connection.commit()
+            return True
+            
+        except Exception as e:
+            logger.error(f"Error saving explanation cache entry: {str(e)}")
+            return False
+    
+    async def increment_counter(self, name: str) -> None:
+        """Increment a named cache counter"""
+        try:
+            cursor = self.connection.cursor()
+            
+            cursor.execute("""
+                INSERT INTO cache_counters (name, value) VALUES (?, 1)
+                ON CONFLICT(name) DO UPDATE SET value = value + 1
+            """, (name,))
+            self.connection.commit()
+            
+        except Exception as e:
+            logger.error(f"Error updating counter {name}: {str(e)}")
+    
+    async def get_counters(self) -> Dict[str, int]:
+        """Get all cache counters"""
+        try:
+            cursor = self.connection.cursor()
+            cursor.execute("SELECT name, value FROM cache_counters")
+            return {row['name']: row['value'] for row in cursor.fetchall()}
+            
+        except Exception as e:
+            logger.error(f"Error getting counters: {str(e)}")
+            return {}
+    
     async def get_recent_analyses(self, limit: int = 10) -> List[Dict]:
         """Get recent analysis results"""
         try:
@@ -248,8 +386,9 @@ class Database:
         try:
             cursor = self.connection.cursor()
             
-            # Delete follow-up questions first
+            # Delete follow-up questions and cache entries first
             cursor.execute("DELETE FROM follow_up_questions WHERE analysis_id = ?", (analysis_id,))
+            cursor.execute("DELETE FROM result_cache WHERE analysis_id = ?", (analysis_id,))
             
             # Delete analysis result
             cursor.execute("DELETE FROM analysis_results WHERE analysis_id = ?", (analysis_id,))
@@ -1,19 +1,24 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException, BackgroundTasks
+from fastapi import FastAPI, File, UploadFile, HTTPException, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 import uvicorn
 import os
 import uuid
 import asyncio
-from typing import Dict, List
+import hashlib
+import json
+from typing import AsyncIterator, Optional
 import logging
 from pathlib import Path
+from pydantic import BaseModel
 
-from services.image_processor import ImageProcessor
-from services.analysis_service import AnalysisService
-from models.efficientnet_model import EfficientNetB0Model
+from services.worker_pool import AnalysisWorkerPool
+from services.job_queue import JobQueue
+from services.progress_hub import ProgressHub, TERMINAL_STATUSES
+from services.quality_gate import QualityGate
+from services.upload_limit import RequestSizeLimit
 from models.medical_llama import MedicalLLaMA
-from database import Database, AnalysisResult
+from database import Database
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -21,7 +26,17 @@ logger = logging.getLogger(__name__)
 
 app = FastAPI(title="BloodCell AI Backend", version="1.0.0")
 
-# CORS middleware
+# Uploads are streamed to disk in chunks, never held in memory whole
+MAX_UPLOAD_MB = int(os.getenv("MAX_UPLOAD_MB", "10"))
+MAX_UPLOAD_BYTES = MAX_UPLOAD_MB * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 256 * 1024
+
+# The multipart body is capped before it is parsed and spooled to a temporary
+# file; the allowance covers boundaries and part headers around the image
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+app.add_middleware(RequestSizeLimit, max_bytes=MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD_BYTES, paths=["/api/upload"])
+
+# CORS middleware, added last so it also wraps size-limit rejections
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:5173", "http://localhost:3000"],  # React dev server
@@ -31,52 +46,139 @@ app.add_middleware(
 )
 
 # Global services
-image_processor = ImageProcessor()
-analysis_service = AnalysisService()
 db = Database()
+job_queue = JobQueue(
+    db.db_path,
+    lease_seconds=float(os.getenv("JOB_LEASE_SECONDS", "60")),
+    max_attempts=int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+)
+
+progress_hub = ProgressHub()
+
+# Finished jobs are removed from the queue after this long
+JOB_TTL_SECONDS = float(os.getenv("JOB_TTL_HOURS", "24")) * 3600
+JOB_CLEANUP_INTERVAL = 600
+PROGRESS_KEEPALIVE_SECONDS = 15
+
+# Unusable images are rejected at upload, before they occupy a worker
+quality_gate = QualityGate(min_blur_score=float(os.getenv("QUALITY_MIN_BLUR_SCORE", "10")))
+
+# Preprocessing and EfficientNet inference run in dedicated worker processes
+worker_pool = AnalysisWorkerPool(
+    num_workers=int(os.getenv("ANALYSIS_WORKERS", "2")),
+    jobs_per_worker=int(os.getenv("ANALYSIS_JOBS_PER_WORKER", "4")),
+    worker_config={
+        "db_path": db.db_path,
+        "lease_seconds": job_queue.lease_seconds,
+        "max_attempts": job_queue.max_attempts,
+        "artifact_dir": os.getenv("MODEL_CACHE_DIR", "model_cache"),
+        "classifier_backend": os.getenv("CLASSIFIER_BACKEND", "tensorflow"),
+        "intra_op_threads": int(os.getenv("CLASSIFIER_INTRA_OP_THREADS", "0")),
+        "inter_op_threads": int(os.getenv("CLASSIFIER_INTER_OP_THREADS", "0")),
+        "int8_min_agreement": float(os.getenv("CLASSIFIER_INT8_MIN_AGREEMENT", "0.95")),
+        "upload_dir": "uploads",
+        "batch_size": int(os.getenv("CLASSIFIER_BATCH_SIZE", "32")),
+        "max_batch": int(os.getenv("INFERENCE_MAX_BATCH", "64")),
+        "max_wait_ms": float(os.getenv("INFERENCE_MAX_WAIT_MS", "10")),
+        "preprocess_workers": int(os.getenv("PREPROCESS_WORKERS", "2")),
+        "preprocess_mode": os.getenv("PREPROCESS_MODE", "classic"),
+        "denoise_mode": os.getenv("DENOISE_MODE", "auto"),
+        "stage_cache_dir": os.getenv("STAGE_CACHE_DIR", "stage_cache"),
+        "stage_cache_mb": int(os.getenv("STAGE_CACHE_MB", "1024")),
+        "tiled_min_side": int(os.getenv("TILED_MIN_SIDE", "0")),
+        "tile_size": int(os.getenv("TILE_SIZE", "1024")),
+        "tile_overlap": int(os.getenv("TILE_OVERLAP", "128")),
+        "tile_workers": int(os.getenv("TILE_WORKERS", "2"))
+    }
+)
 
 # AI Models (loaded on startup)
-efficientnet_model = None
 medical_llama = None
-
-# Store analysis progress
-analysis_progress: Dict[str, dict] = {}
+llm_load_task = None
+cleanup_task = None
 
 @app.on_event("startup")
 async def startup_event():
     """Initialize AI models on startup"""
-    global efficientnet_model, medical_llama
+    global medical_llama, llm_load_task, cleanup_task
     
-    logger.info("Loading AI models...")
+    # Initialize database and job queue
+    await db.init_db()
+    await job_queue.init_queue()
+    cleanup_task = asyncio.create_task(cleanup_finished_jobs())
     
-    # Load EfficientNet B0 model
-    efficientnet_model = EfficientNetB0Model()
-    await efficientnet_model.load_model()
+    logger.info("Loading AI models...")
     
-    # Load Medical LLaMA model
-    medical_llama = MedicalLLaMA()
-    await medical_llama.load_model()
+    # Start analysis workers; each loads EfficientNet B0 once and
+    # resumes any jobs left queued or running before a restart
+    worker_pool.start(on_progress=progress_hub.publish)
     
-    # Initialize database
-    await db.init_db()
+    # Load Medical LLaMA in the background; explanation requests wait for it
+    medical_llama = MedicalLLaMA(
+        cache=db,
+        cache_size=int(os.getenv("EXPLANATION_CACHE_SIZE", "1000")),
+        backend=os.getenv("LLM_BACKEND", "transformers"),
+        gguf_path=os.getenv("LLM_GGUF_PATH"),
+        num_threads=int(os.getenv("LLM_THREADS", "0")),
+        max_batch_size=int(os.getenv("LLM_MAX_BATCH", "8")),
+        max_wait_ms=float(os.getenv("LLM_MAX_WAIT_MS", "50")),
+        session_ttl_seconds=float(os.getenv("FOLLOW_UP_SESSION_TTL_SECONDS", "1800")),
+        session_memory_mb=int(os.getenv("FOLLOW_UP_SESSION_MEMORY_MB", "512")),
+        follow_up_turns=int(os.getenv("FOLLOW_UP_TURNS", "2"))
+    )
+    llm_load_task = asyncio.create_task(medical_llama.load_model())
     
-    logger.info("AI models loaded successfully!")
+    logger.info("Accepting requests while AI models load in the background")
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Stop background inference services"""
+    if cleanup_task:
+        cleanup_task.cancel()
+    if medical_llama:
+        await medical_llama.shutdown()
+    await asyncio.to_thread(worker_pool.stop)
+    job_queue.close()
 
 @app.get("/")
 async def root():
     return {"message": "BloodCell AI Backend is running"}
 
+@app.get("/ready")
+async def readiness():
+    """Report per-model load state; 503 until the image analysis path is ready"""
+    
+    workers_ready = len(worker_pool.ready_workers)
+    cv_ready = workers_ready > 0
+    
+    status = {
+        "ready": cv_ready,
+        "models": {
+            "efficientnet_b0": {
+                "state": "ready" if cv_ready else "loading",
+                "workers_ready": workers_ready,
+                "workers_total": worker_pool.num_workers
+            },
+            "medical_llm": {
+                "state": medical_llama.load_state if medical_llama else "not_loaded",
+                **(medical_llama.load_report if medical_llama else {})
+            }
+        }
+    }
+    
+    return JSONResponse(status, status_code=200 if cv_ready else 503)
+
 @app.post("/api/upload")
-async def upload_image(background_tasks: BackgroundTasks, file: UploadFile = File(...)):
+async def upload_image(file: UploadFile = File(...)):
     """Upload and validate blood smear image"""
     
     # Validate file type
     if not file.content_type.startswith('image/'):
         raise HTTPException(status_code=400, detail="File must be an image")
     
-    # Validate file size (max 10MB)
-    if file.size > 10 * 1024 * 1024:
-        raise HTTPException(status_code=400, detail="File size too large (max 10MB)")
+    # Reject early when the client declared an oversized file
+    if file.size is not None and file.size > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=400, detail=f"File size too large (max {MAX_UPLOAD_MB}MB)")
     
     # Generate unique analysis ID
     analysis_id = str(uuid.uuid4())
@@ -88,39 +190,113 @@ async def upload_image(background_tasks: BackgroundTasks, file: UploadFile = Fil
         
         file_path = upload_dir / f"{analysis_id}_{file.filename}"
         
-        with open(file_path, "wb") as buffer:
-            content = await file.read()
-            buffer.write(content)
+        image_hash = await save_upload(file, file_path)
         
-        # Initialize analysis progress
-        analysis_progress[analysis_id] = {
-            "status": "uploaded",
-            "progress": 10,
-            "stage": "Image uploaded successfully"
-        }
+        # Check brightness and sharpness on a reduced-resolution decode
+        quality = await asyncio.to_thread(quality_gate.check, str(file_path))
+        if not quality.passed:
+            file_path.unlink(missing_ok=True)
+            raise HTTPException(
+                status_code=422,
+                detail={"message": "; ".join(quality.issues), "quality": quality.to_dict()}
+            )
         
-        # Start background analysis
-        background_tasks.add_task(perform_analysis, analysis_id, str(file_path))
+        # Queue analysis for the worker pool
+        await job_queue.enqueue(analysis_id, str(file_path), image_hash)
         
         return {
             "analysis_id": analysis_id,
             "filename": file.filename,
             "status": "uploaded",
+            "sha256": image_hash,
+            "quality": quality.to_dict(),
             "message": "Image uploaded successfully. Analysis started."
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error uploading file: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error uploading file: {str(e)}")
 
+async def save_upload(file: UploadFile, file_path: Path) -> str:
+    """Stream an upload to disk, enforcing the size limit and hashing on the fly"""
+    
+    digest = hashlib.sha256()
+    size = 0
+    
+    try:
+        with open(file_path, "wb") as buffer:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if size > MAX_UPLOAD_BYTES:
+                    raise HTTPException(status_code=400, detail=f"File size too large (max {MAX_UPLOAD_MB}MB)")
+                
+                digest.update(chunk)
+                buffer.write(chunk)
+    except Exception:
+        file_path.unlink(missing_ok=True)
+        raise
+    
+    return digest.hexdigest()
+
 @app.get("/api/progress/{analysis_id}")
 async def get_analysis_progress(analysis_id: str):
     """Get real-time analysis progress"""
     
-    if analysis_id not in analysis_progress:
-        raise HTTPException(status_code=404, detail="Analysis not found")
+    progress = await job_queue.get_progress(analysis_id)
+    if progress:
+        return progress
+    
+    # Finished jobs are evicted from the queue; fall back to stored results
+    if await db.get_analysis_result(analysis_id):
+        return {
+            "status": "completed",
+            "progress": 100,
+            "stage": "Analysis completed successfully!"
+        }
+    
+    raise HTTPException(status_code=404, detail="Analysis not found")
+
+@app.get("/api/progress/{analysis_id}/stream")
+async def stream_analysis_progress(analysis_id: str):
+    """Stream analysis progress as Server-Sent Events"""
+    
+    await get_analysis_progress(analysis_id)
+    
+    async def event_stream():
+        async for update in watch_analysis_progress(analysis_id):
+            if update is None:
+                yield ": keepalive\n\n"
+            else:
+                yield f"data: {json.dumps(update)}\n\n"
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.websocket("/ws/progress/{analysis_id}")
+async def websocket_analysis_progress(websocket: WebSocket, analysis_id: str):
+    """Stream analysis progress over a WebSocket"""
+    
+    await websocket.accept()
     
-    return analysis_progress[analysis_id]
+    try:
+        await get_analysis_progress(analysis_id)
+    except HTTPException as e:
+        await websocket.send_json({"status": "error", "progress": 0, "stage": e.detail})
+        await websocket.close(code=4404)
+        return
+    
+    try:
+        async for update in watch_analysis_progress(analysis_id):
+            if update is not None:
+                await websocket.send_json(update)
+        await websocket.close()
+    except WebSocketDisconnect:
+        pass
 
 @app.get("/api/results/{analysis_id}")
 async def get_analysis_results(analysis_id: str):
@@ -132,6 +308,22 @@ async def get_analysis_results(analysis_id: str):
     
     return result
 
+@app.get("/api/cache/stats")
+async def get_cache_stats():
+    """Get result cache hit/miss counters"""
+    
+    counters = await db.get_counters()
+    hits = counters.get("result_cache_hits", 0)
+    misses = counters.get("result_cache_misses", 0)
+    lookups = hits + misses
+    
+    return {
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": hits / lookups if lookups else 0.0,
+        "follow_up_sessions": medical_llama.sessions.stats() if medical_llama else {}
+    }
+
 @app.post("/api/medical-explanation/{analysis_id}")
 async def generate_medical_explanation(analysis_id: str):
     """Generate AI-powered medical explanation"""
@@ -154,77 +346,100 @@ async def generate_medical_explanation(analysis_id: str):
         logger.error(f"Error generating explanation: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error generating explanation: {str(e)}")
 
-async def perform_analysis(analysis_id: str, image_path: str):
-    """Background task to perform complete blood cell analysis"""
+@app.post("/api/medical-explanation/{analysis_id}/stream")
+async def stream_medical_explanation(analysis_id: str):
+    """Stream the AI-powered medical explanation as it is generated"""
     
-    try:
-        # Update progress: Image preprocessing
-        analysis_progress[analysis_id].update({
-            "status": "preprocessing",
-            "progress": 20,
-            "stage": "Preprocessing image..."
-        })
-        
-        # Preprocess image
-        processed_image = await image_processor.preprocess_image(image_path)
-        
-        # Update progress: EfficientNet analysis
-        analysis_progress[analysis_id].update({
-            "status": "analyzing",
-            "progress": 40,
-            "stage": "EfficientNet B0 analysis..."
-        })
-        
-        # Perform EfficientNet B0 analysis
-        cell_analysis = await efficientnet_model.analyze_cells(processed_image)
-        
-        # Update progress: Disease detection
-        analysis_progress[analysis_id].update({
-            "status": "detecting",
-            "progress": 70,
-            "stage": "Disease detection..."
-        })
-        
-        # Perform disease detection
-        disease_results = await analysis_service.detect_diseases(cell_analysis)
-        
-        # Update progress: Finalizing
-        analysis_progress[analysis_id].update({
-            "status": "finalizing",
-            "progress": 90,
-            "stage": "Finalizing results..."
-        })
-        
-        # Prepare final results
-        final_results = {
-            "analysis_id": analysis_id,
-            "cell_counts": cell_analysis["cell_counts"],
-            "diseases": disease_results["diseases"],
-            "abnormalities": disease_results["abnormalities"],
-            "confidence_scores": cell_analysis["confidence_scores"],
-            "image_path": image_path,
-            "timestamp": cell_analysis["timestamp"]
-        }
+    result = await db.get_analysis_result(analysis_id)
+    if not result:
+        raise HTTPException(status_code=404, detail="Analysis results not found")
+    
+    async def explanation_stream():
+        chunks = []
+        try:
+            async for text in medical_llama.stream_explanation(result):
+                chunks.append(text)
+                yield text
+        except Exception as e:
+            # Headers are already sent, so the error can only be logged
+            logger.error(f"Error streaming explanation: {str(e)}")
+            return
         
-        # Save to database
-        await db.save_analysis_result(AnalysisResult(**final_results))
+        await db.update_analysis_explanation(analysis_id, "".join(chunks).strip())
+    
+    return StreamingResponse(
+        explanation_stream(),
+        media_type="text/plain; charset=utf-8",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+class FollowUpRequest(BaseModel):
+    question: str
+
+@app.post("/api/follow-up/{analysis_id}")
+async def ask_follow_up_question(analysis_id: str, request: FollowUpRequest):
+    """Answer a follow-up question in the context of an analysis and earlier questions"""
+    
+    result = await db.get_analysis_result(analysis_id)
+    if not result:
+        raise HTTPException(status_code=404, detail="Analysis results not found")
+    
+    question = request.question.strip()
+    if not question:
+        raise HTTPException(status_code=400, detail="Question must not be empty")
+    
+    try:
+        history = await db.get_follow_up_questions(analysis_id)
+        answer = await medical_llama.answer_follow_up_question(
+            question, result, analysis_id=analysis_id, history=history
+        )
         
-        # Update progress: Complete
-        analysis_progress[analysis_id].update({
-            "status": "completed",
-            "progress": 100,
-            "stage": "Analysis completed successfully!"
-        })
+        await db.save_follow_up_question(analysis_id, question, answer)
         
-        logger.info(f"Analysis {analysis_id} completed successfully")
+        return {"analysis_id": analysis_id, "question": question, "answer": answer}
         
     except Exception as e:
-        logger.error(f"Error in analysis {analysis_id}: {str(e)}")
-        analysis_progress[analysis_id].update({
-            "status": "error",
-            "progress": 0,
-            "stage": f"Analysis failed: {str(e)}"
-        })
+        logger.error(f"Error answering follow-up question: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error answering follow-up question: {str(e)}")
+
+@app.get("/api/follow-up/{analysis_id}")
+async def get_follow_up_questions(analysis_id: str):
+    """Get the follow-up questions and answers of an analysis"""
+    
+    questions = await db.get_follow_up_questions(analysis_id)
+    return {"analysis_id": analysis_id, "questions": questions}
+
+async def watch_analysis_progress(analysis_id: str) -> AsyncIterator[Optional[dict]]:
+    """Yield the current progress, then each pushed update until the analysis finishes.
+    
+    Yields None when no update arrived within the keepalive interval.
+    """
+    # Subscribe before reading the current state so no transition is missed
+    queue = progress_hub.subscribe(analysis_id)
+    
+    try:
+        update = await get_analysis_progress(analysis_id)
+        
+        while True:
+            yield update
+            if update and update["status"] in TERMINAL_STATUSES:
+                return
+            
+            try:
+                update = await asyncio.wait_for(queue.get(), timeout=PROGRESS_KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                update = None
+    finally:
+        progress_hub.unsubscribe(analysis_id, queue)
+
+async def cleanup_finished_jobs():
+    """Periodically evict finished jobs past their TTL"""
+    while True:
+        try:
+            await job_queue.cleanup(JOB_TTL_SECONDS)
+        except Exception as e:
+            logger.error(f"Error cleaning up job queue: {str(e)}")
+        await asyncio.sleep(JOB_CLEANUP_INTERVAL)
 
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -0,0 +1,167 @@
+import tensorflow as tf
+import numpy as np
+from typing import Dict, List
+import logging
+import time
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+class ClassifierBackend:
+    """Inference backend for the cell classifier: float32 patches in, class probabilities out"""
+
+    name = "base"
+
+    def predict(self, batch: np.ndarray) -> np.ndarray:
+        raise NotImplementedError
+
+class TensorFlowBackend(ClassifierBackend):
+    """Float32 inference through the exported SavedModel concrete function"""
+
+    name = "tensorflow"
+
+    def __init__(self, module):
+        self.classify = module.classify
+
+    def predict(self, batch: np.ndarray) -> np.ndarray:
+        return self.classify(batch).numpy()
+
+class TFLiteInt8Backend(ClassifierBackend):
+    """Post-training int8-quantized classifier run by the TFLite interpreter"""
+
+    name = "tflite_int8"
+
+    def __init__(self, model_path: Path, batch_size: int, num_threads: int = None):
+        self.interpreter = tf.lite.Interpreter(model_path=str(model_path), num_threads=num_threads)
+        self._input_index = self.interpreter.get_input_details()[0]['index']
+        self._output_index = self.interpreter.get_output_details()[0]['index']
+        self._batch_size = None
+        self._resize(batch_size)
+
+    def _resize(self, batch_size: int):
+        input_shape = self.interpreter.get_input_details()[0]['shape']
+        self.interpreter.resize_tensor_input(self._input_index, [batch_size, *input_shape[1:]])
+        self.interpreter.allocate_tensors()
+        self._batch_size = batch_size
+
+    def predict(self, batch: np.ndarray) -> np.ndarray:
+        if len(batch) != self._batch_size:
+            self._resize(len(batch))
+
+        self.interpreter.set_tensor(self._input_index, batch.astype(np.float32, copy=False))
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self._output_index).copy()
+
+    @staticmethod
+    def quantize(module, calibration_patches: np.ndarray) -> bytes:
+        """Convert the float classifier to int8 using `calibration_patches` as representative data"""
+
+        def representative_dataset():
+            for patch in calibration_patches:
+                yield [patch[np.newaxis].astype(np.float32)]
+
+        converter = tf.lite.TFLiteConverter.from_concrete_functions(
+            [module.classify.get_concrete_function()], module
+        )
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+
+        return converter.convert()
+
+class OnnxRuntimeBackend(ClassifierBackend):
+    """Float32 classifier exported from the Keras graph and run by ONNX Runtime"""
+
+    name = "onnx"
+
+    def __init__(self, model_path: Path, intra_op_threads: int = 0, inter_op_threads: int = 0):
+        # Optional dependency; only needed when this backend is selected
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+        self.session = ort.InferenceSession(str(model_path), options, providers=["CPUExecutionProvider"])
+        self._input_name = self.session.get_inputs()[0].name
+
+    def predict(self, batch: np.ndarray) -> np.ndarray:
+        return self.session.run(None, {self._input_name: batch.astype(np.float32, copy=False)})[0]
+
+    @staticmethod
+    def export(module, output_path: Path, opset: int = 13):
+        """Convert the classifier's concrete function to an ONNX graph"""
+        import tf2onnx
+        from tensorflow.python.framework.convert_to_constants import convert_variables_to_constants_v2
+
+        # Freeze variables into the graph so the converter sees a self-contained GraphDef
+        frozen = convert_variables_to_constants_v2(module.classify.get_concrete_function())
+
+        tf2onnx.convert.from_graph_def(
+            frozen.graph.as_graph_def(),
+            input_names=[tensor.name for tensor in frozen.inputs],
+            output_names=[tensor.name for tensor in frozen.outputs],
+            opset=opset,
+            output_path=str(output_path)
+        )
+
+def benchmark_backend(backend: ClassifierBackend, batch_sizes=(1, 16, 64, 256),
+                      repeats: int = 5, input_shape=(224, 224, 3)) -> List[Dict]:
+    """Median latency and throughput of a backend at each batch size"""
+    results = []
+    rng = np.random.default_rng(0)
+
+    for batch_size in batch_sizes:
+        batch = rng.random((batch_size, *input_shape), dtype=np.float32)
+
+        # Warm-up call absorbs graph tracing and allocation
+        backend.predict(batch)
+
+        timings = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            backend.predict(batch)
+            timings.append(time.perf_counter() - start)
+
+        latency = float(np.median(timings))
+        results.append({
+            "backend": backend.name,
+            "batch_size": batch_size,
+            "latency_ms": latency * 1000,
+            "patches_per_sec": batch_size / latency
+        })
+
+    return results
+
+def compare_backends(reference: ClassifierBackend, candidate: ClassifierBackend,
+                     patches: np.ndarray, batch_size: int) -> Dict:
+    """Accuracy delta and throughput of `candidate` measured against `reference`"""
+
+    def run(backend: ClassifierBackend):
+        outputs = []
+        start = time.perf_counter()
+        for i in range(0, len(patches), batch_size):
+            outputs.append(backend.predict(patches[i:i + batch_size]))
+        elapsed = time.perf_counter() - start
+        return np.concatenate(outputs), elapsed
+
+    reference_probs, reference_time = run(reference)
+    candidate_probs, candidate_time = run(candidate)
+
+    reference_top1 = reference_probs.argmax(axis=1)
+    candidate_top1 = candidate_probs.argmax(axis=1)
+    abs_diff = np.abs(reference_probs - candidate_probs)
+
+    return {
+        "reference": reference.name,
+        "candidate": candidate.name,
+        "patches": int(len(patches)),
+        "top1_agreement": float(np.mean(reference_top1 == candidate_top1)),
+        "mean_abs_prob_delta": float(abs_diff.mean()),
+        "max_abs_prob_delta": float(abs_diff.max()),
+        "mean_confidence_delta": float(candidate_probs.max(axis=1).mean() - reference_probs.max(axis=1).mean()),
+        "reference_patches_per_sec": float(len(patches) / reference_time),
+        "candidate_patches_per_sec": float(len(patches) / candidate_time),
+        "speedup": float(reference_time / candidate_time)
+    }
@@ -1,18 +1,37 @@
 import tensorflow as tf
 import numpy as np
 import cv2
-from typing import Dict, List, Tuple
+from typing import Awaitable, Callable, Dict, List, Tuple
+import json
 import logging
 from datetime import datetime
 import asyncio
+import os
+import shutil
+from pathlib import Path
+
+from models.classifier_backends import (
+    OnnxRuntimeBackend, TensorFlowBackend, TFLiteInt8Backend, compare_backends
+)
 
 logger = logging.getLogger(__name__)
 
 class EfficientNetB0Model:
     """EfficientNet B0 model for blood cell classification and analysis"""
     
-    def __init__(self):
+    def __init__(self, batch_size: int = 32, artifact_dir: str = "model_cache"):
         self.model = None
+        self.artifact_dir = Path(artifact_dir)
+        self.model_version = "efficientnet_b0-imagenet-v1"
+        self.batch_size = batch_size
+        self.input_shape = (224, 224, 3)
+        self.backend = "tensorflow"
+        self.classifier = None  # ClassifierBackend; None while using the mock model
+        self.batcher = None  # Optional shared InferenceBatcher
+        self.max_patches_per_step = 256  # patches stacked per classification step
+        self.min_int8_evaluation_patches = 50  # held-out patches needed to trust the int8 agreement
+        self._patch_staging = None  # reused uint8 buffer that cell regions are resized into
+        self.detection_field = (1024, 1024)  # canvas the detection limits and count estimates are tuned on
         self.cell_classes = [
             'Neutrophils', 'Lymphocytes', 'Monocytes', 
             'Eosinophils', 'Basophils', 'Platelets', 'RBCs'
@@ -28,41 +47,179 @@ class EfficientNetB0Model:
         }
     
     async def load_model(self):
-        """Load pre-trained EfficientNet B0 model"""
+        """Load the EfficientNet B0 classifier, from the local artifact store when available"""
         try:
             logger.info("Loading EfficientNet B0 model...")
             
-            # Load EfficientNet B0 base model
-            base_model = tf.keras.applications.EfficientNetB0(
-                weights='imagenet',
-                include_top=False,
-                input_shape=(224, 224, 3)
-            )
+            if (self.artifact_path / "saved_model.pb").exists():
+                # Inference-only SavedModel: no network access, no Keras graph or optimizer state
+                logger.info(f"Loading EfficientNet B0 artifact from {self.artifact_path}")
+                self.model = tf.saved_model.load(str(self.artifact_path))
+            else:
+                self.model = self._build_and_export_model()
             
-            # Add custom classification layers for blood cells
-            model = tf.keras.Sequential([
-                base_model,
-                tf.keras.layers.GlobalAveragePooling2D(),
-                tf.keras.layers.Dropout(0.2),
-                tf.keras.layers.Dense(128, activation='relu'),
-                tf.keras.layers.Dropout(0.2),
-                tf.keras.layers.Dense(len(self.cell_classes), activation='softmax')
-            ])
+            # Batches are padded to a fixed size, so this concrete function is never retraced
+            self.classifier = TensorFlowBackend(self.model)
             
-            # Compile model
-            model.compile(
-                optimizer='adam',
-                loss='categorical_crossentropy',
-                metrics=['accuracy']
-            )
-            
-            self.model = model
             logger.info("EfficientNet B0 model loaded successfully")
             
         except Exception as e:
             logger.error(f"Error loading EfficientNet B0 model: {str(e)}")
             # Use mock model for demo purposes
             self.model = self._create_mock_model()
+            self.model_version = "mock"
+    
+    async def select_backend(self, backend: str,
+                             calibration_images: Callable[[], Awaitable[List[np.ndarray]]] = None,
+                             max_calibration_patches: int = 500,
+                             intra_op_threads: int = 0, inter_op_threads: int = 0,
+                             min_int8_agreement: float = 0.95) -> bool:
+        """Switch the classifier to another inference backend; False keeps the current one.
+        
+        The int8 classifier is only used when its top-1 agreement with the float
+        model on held-out patches reaches `min_int8_agreement`.
+        """
+        if backend == self.backend or self.classifier is None:
+            return backend == self.backend
+        
+        try:
+            if backend == "tflite_int8":
+                model_path = self.artifact_path / "classifier_int8.tflite"
+                if not model_path.exists():
+                    await self._export_int8_model(model_path, calibration_images, max_calibration_patches)
+                self._check_int8_agreement(model_path, min_int8_agreement)
+                self.classifier = TFLiteInt8Backend(model_path, self.batch_size)
+            elif backend == "onnx":
+                model_path = self.artifact_path / "classifier.onnx"
+                if not model_path.exists():
+                    self._export_onnx_model(model_path)
+                self.classifier = OnnxRuntimeBackend(model_path, intra_op_threads, inter_op_threads)
+            else:
+                raise ValueError(f"Unknown classifier backend: {backend}")
+            
+            self.backend = backend
+            logger.info(f"Cell classifier using {backend} backend")
+            return True
+            
+        except Exception as e:
+            logger.error(f"Could not enable {backend} backend, keeping {self.backend}: {str(e)}")
+            return False
+    
+    def _check_int8_agreement(self, model_path: Path, min_agreement: float):
+        """Raise unless the int8 model's recorded top-1 agreement reaches `min_agreement`"""
+        report_path = model_path.with_name("classifier_int8_report.json")
+        if not report_path.exists():
+            raise ValueError(f"no accuracy report for the int8 classifier at {report_path}")
+        
+        report = json.loads(report_path.read_text())
+        if not report.get("verified", True) or "top1_agreement" not in report:
+            raise ValueError(f"int8 classifier accuracy was not verified: {report.get('reason', 'no agreement measured')}")
+        
+        agreement = report["top1_agreement"]
+        if agreement < min_agreement:
+            raise ValueError(f"int8 top-1 agreement {agreement:.3f} is below the minimum {min_agreement:.3f}")
+    
+    def _export_onnx_model(self, model_path: Path):
+        """Export the classifier graph to ONNX next to the SavedModel"""
+        logger.info("Exporting cell classifier to ONNX")
+        staging_path = model_path.with_name(f".{model_path.name}.{os.getpid()}")
+        OnnxRuntimeBackend.export(self.model, staging_path)
+        os.replace(staging_path, model_path)
+    
+    async def _export_int8_model(self, model_path: Path,
+                                 calibration_images: Callable[[], Awaitable[List[np.ndarray]]],
+                                 max_patches: int):
+        """Quantize the classifier with patches from stored images and report the accuracy delta"""
+        patches = []
+        for image in await calibration_images():
+            patches.extend(await self.extract_patches(image))
+            if len(patches) >= max_patches:
+                break
+        
+        if not patches:
+            raise ValueError("no stored images available for int8 calibration")
+        
+        patches = np.stack(patches[:max_patches])
+        
+        # Calibrate on most patches and measure the accuracy delta on the held-out rest
+        np.random.default_rng(0).shuffle(patches)
+        split = max(1, int(len(patches) * 0.8))
+        calibration, evaluation = patches[:split], patches[split:]
+        
+        report_path = model_path.with_name("classifier_int8_report.json")
+        if len(evaluation) < self.min_int8_evaluation_patches:
+            # Agreement measured on the calibration data would say nothing. Record why
+            # and install no model, so the next start tries again with more uploads
+            report = {"verified": False, "patches": int(len(patches)),
+                      "reason": f"{len(evaluation)} held-out patches, {self.min_int8_evaluation_patches} required"}
+            report_path.write_text(json.dumps(report, indent=2))
+            logger.warning(f"Int8 classifier not verified: {report['reason']}")
+            return
+        
+        logger.info(f"Quantizing cell classifier to int8 with {len(calibration)} calibration patches")
+        staging_path = model_path.with_name(f".{model_path.name}.{os.getpid()}")
+        staging_path.write_bytes(TFLiteInt8Backend.quantize(self.model, calibration))
+        
+        report = {"verified": True, **compare_backends(
+            self.classifier, TFLiteInt8Backend(staging_path, self.batch_size), evaluation, self.batch_size
+        )}
+        report_path.write_text(json.dumps(report, indent=2))
+        os.replace(staging_path, model_path)
+        
+        logger.info(
+            f"Int8 classifier: top-1 agreement {report['top1_agreement']:.3f}, "
+            f"mean prob delta {report['mean_abs_prob_delta']:.4f}, speedup {report['speedup']:.2f}x"
+        )
+    
+    @property
+    def artifact_path(self) -> Path:
+        return self.artifact_dir / self.model_version
+    
+    def _build_and_export_model(self) -> tf.Module:
+        """Assemble the Keras classifier once and save it to the artifact store"""
+        logger.info("No EfficientNet B0 artifact found, building model from ImageNet weights")
+        
+        # Load EfficientNet B0 base model
+        base_model = tf.keras.applications.EfficientNetB0(
+            weights='imagenet',
+            include_top=False,
+            input_shape=self.input_shape
+        )
+        
+        # Add custom classification layers for blood cells
+        classifier = tf.keras.Sequential([
+            base_model,
+            tf.keras.layers.GlobalAveragePooling2D(),
+            tf.keras.layers.Dropout(0.2),
+            tf.keras.layers.Dense(128, activation='relu'),
+            tf.keras.layers.Dropout(0.2),
+            tf.keras.layers.Dense(len(self.cell_classes), activation='softmax')
+        ])
+        
+        # Export only the inference function and its variables
+        module = tf.Module()
+        module.classifier = classifier
+        module.classify = tf.function(
+            lambda x: classifier(x, training=False),
+            input_signature=[tf.TensorSpec((None, *self.input_shape), tf.float32)]
+        )
+        
+        # Write to a private directory first; concurrent workers may race to export
+        self.artifact_dir.mkdir(parents=True, exist_ok=True)
+        staging_path = self.artifact_dir / f".{self.model_version}.{os.getpid()}"
+        tf.saved_model.save(module, str(staging_path))
+        
+        try:
+            staging_path.rename(self.artifact_path)
+            logger.info(f"EfficientNet B0 artifact saved to {self.artifact_path}")
+        except OSError:
+            # Another worker exported first. The head weights are random, so serve
+            # its artifact rather than this module, or workers would disagree
+            shutil.rmtree(staging_path, ignore_errors=True)
+            logger.info(f"Using EfficientNet B0 artifact exported by another worker at {self.artifact_path}")
+            return tf.saved_model.load(str(self.artifact_path))
+
+        return module
     
     def _create_mock_model(self):
         """Create a mock model for demonstration purposes"""
@@ -76,26 +233,30 @@ class EfficientNetB0Model:
         
         return MockModel()
     
-    async def analyze_cells(self, processed_image: np.ndarray) -> Dict:
-        """Analyze blood cells in the processed image"""
+    async def analyze_cells(self, processed_image: np.ndarray, fields: float = 1.0) -> Dict:
+        """Analyze blood cells in the processed image, which covers `fields` of the canvas"""
+        logger.info("Starting EfficientNet B0 cell analysis...")
+        
+        # Detect and segment cells
+        cell_regions = await self._detect_cells(processed_image)
+        
+        return await self.analyze_regions(cell_regions, fields)
+    
+    async def analyze_regions(self, cell_regions: List[np.ndarray], fields: float = 1.0) -> Dict:
+        """Classify detected cell regions and summarize counts and confidence.
+        
+        `fields` is the analysed area in detection fields, so absolute counts
+        are estimated from the cell density rather than the raw number found.
+        """
         try:
-            logger.info("Starting EfficientNet B0 cell analysis...")
-            
-            # Detect and segment cells
-            cell_regions = await self._detect_cells(processed_image)
-            
-            # Classify each cell region
+            # Classify cell regions a bounded number at a time; tiled slides yield thousands
             cell_predictions = []
-            for region in cell_regions:
-                # Preprocess cell region for classification
-                cell_patch = self._preprocess_cell_patch(region)
-                
-                # Get prediction from model
-                prediction = self.model.predict(np.expand_dims(cell_patch, axis=0))
-                cell_predictions.append(prediction[0])
+            for start in range(0, len(cell_regions), self.max_patches_per_step):
+                patches = self._patch_batch(cell_regions[start:start + self.max_patches_per_step])
+                cell_predictions.extend(await self._classify_patches(patches))
             
             # Calculate cell counts and percentages
-            cell_counts = await self._calculate_cell_counts(cell_predictions)
+            cell_counts = await self._calculate_cell_counts(cell_predictions, fields)
             
             # Calculate confidence scores
             confidence_scores = await self._calculate_confidence_scores(cell_predictions)
@@ -112,59 +273,18 @@ class EfficientNetB0Model:
             # Return mock results for demo
             return await self._get_mock_analysis_results()
     
+    async def extract_patches(self, processed_image: np.ndarray) -> List[np.ndarray]:
+        """Detect cells and return their classifier-ready patches"""
+        cell_regions = await self._detect_cells(processed_image)
+        return list(self._patch_batch(cell_regions))
+    
     async def _detect_cells(self, image: np.ndarray) -> List[np.ndarray]:
         """Detect individual cells in the blood smear image"""
         try:
-            # Convert to grayscale
-            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+            boxes = self.detect_cell_boxes(image)
             
-            # Apply Gaussian blur
-            blurred = cv2.GaussianBlur(gray, (5, 5), 0)
-            
-            # Use HoughCircles to detect circular cells
-            circles = cv2.HoughCircles(
-                blurred,
-                cv2.HOUGH_GRADIENT,
-                dp=1,
-                minDist=30,
-                param1=50,
-                param2=30,
-                minRadius=10,
-                maxRadius=50
-            )
-            
-            cell_regions = []
-            if circles is not None:
-                circles = np.round(circles[0, :]).astype("int")
-                
-                for (x, y, r) in circles:
-                    # Extract cell region with padding
-                    padding = 10
-                    x1 = max(0, x - r - padding)
-                    y1 = max(0, y - r - padding)
-                    x2 = min(image.shape[1], x + r + padding)
-                    y2 = min(image.shape[0], y + r + padding)
-                    
-                    cell_region = image[y1:y2, x1:x2]
-                    if cell_region.size > 0:
-                        cell_regions.append(cell_region)
-            
-            # Enhance detection with additional computer vision techniques
-            if len(cell_regions) < 50:
-                # Use contour detection as backup
-                contours, _ = cv2.findContours(
-                    cv2.threshold(blurred, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1],
-                    cv2.RETR_EXTERNAL, cv2.CV_CHAIN_APPROX_SIMPLE
-                )
-                
-                for contour in contours:
-                    area = cv2.contourArea(contour)
-                    if 100 < area < 2000:  # Filter by reasonable cell size
-                        x, y, w, h = cv2.boundingRect(contour)
-                        if w > 20 and h > 20:  # Minimum size check
-                            cell_region = image[y:y+h, x:x+w]
-                            if cell_region.size > 0:
-                                cell_regions.append(cell_region)
+            # Views into the image; pixels are only copied when resized into a patch batch
+            cell_regions = [image[y1:y2, x1:x2] for x1, y1, x2, y2 in boxes]
             
             logger.info(f"Detected {len(cell_regions)} cell regions")
             return cell_regions
@@ -174,17 +294,146 @@ class EfficientNetB0Model:
             # Return mock cell regions
             return [np.random.randint(0, 255, (50, 50, 3), dtype=np.uint8) for _ in range(150)]
     
+    def detect_cell_boxes(self, image: np.ndarray, scale: float = 1.0) -> np.ndarray:
+        """Bounding boxes (x1, y1, x2, y2) of the cells in a preprocessed image.
+        
+        The size limits are tuned on the detection field. `scale` is the number
+        of image pixels per field pixel: a full-resolution tile is searched
+        downscaled to field resolution and its boxes mapped back, which keeps
+        the limits right and the Hough radius range small.
+        """
+        image_height, image_width = image.shape[:2]
+        
+        if scale > 1.0:
+            reduced = cv2.resize(
+                image, (max(1, round(image_width / scale)), max(1, round(image_height / scale))),
+                interpolation=cv2.INTER_AREA
+            )
+            boxes = np.round(self.detect_cell_boxes(reduced) * scale).astype(np.int32)
+            np.clip(boxes[:, 0::2], 0, image_width, out=boxes[:, 0::2])
+            np.clip(boxes[:, 1::2], 0, image_height, out=boxes[:, 1::2])
+            return boxes[(boxes[:, 2] > boxes[:, 0]) & (boxes[:, 3] > boxes[:, 1])]
+        
+        # The contour fallback is for sparse fields; a tile is a fraction of one
+        field_width, field_height = self.detection_field
+        fields = image_width * image_height / (field_width * field_height)
+        
+        # Convert to grayscale
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        
+        # Apply Gaussian blur
+        blurred = cv2.GaussianBlur(gray, (5, 5), 0)
+        
+        # Use HoughCircles to detect circular cells
+        circles = cv2.HoughCircles(
+            blurred,
+            cv2.HOUGH_GRADIENT,
+            dp=1,
+            minDist=30,
+            param1=50,
+            param2=30,
+            minRadius=10,
+            maxRadius=50
+        )
+        
+        boxes = []
+        if circles is not None:
+            circles = np.round(circles[0, :]).astype("int")
+            
+            for (x, y, r) in circles:
+                # Cell region with padding, clipped to the image
+                padding = 10
+                boxes.append((
+                    max(0, x - r - padding),
+                    max(0, y - r - padding),
+                    min(image_width, x + r + padding),
+                    min(image_height, y + r + padding)
+                ))
+        
+        # Enhance detection with additional computer vision techniques
+        if len(boxes) < 50 * fields:
+            # Use contour detection as backup
+            contours, _ = cv2.findContours(
+                cv2.threshold(blurred, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1],
+                cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE
+            )
+            
+            for contour in contours:
+                area = cv2.contourArea(contour)
+                if 100 < area < 2000:  # Filter by reasonable cell size
+                    x, y, w, h = cv2.boundingRect(contour)
+                    if w > 20 and h > 20:  # Minimum size check
+                        boxes.append((x, y, x + w, y + h))
+        
+        boxes = np.array(boxes, dtype=np.int32).reshape(-1, 4)
+        
+        # Drop boxes that were clipped to nothing
+        return boxes[(boxes[:, 2] > boxes[:, 0]) & (boxes[:, 3] > boxes[:, 1])]
+    
+    async def _classify_patches(self, patches: np.ndarray) -> np.ndarray:
+        """Classify patches through the shared batcher when one is attached"""
+        if self.batcher is not None:
+            return await self.batcher.predict(patches)
+        return self.predict_patches(patches)
+    
+    def predict_patches(self, patches: np.ndarray) -> np.ndarray:
+        """Classify a stack of preprocessed cell patches in fixed-size batches"""
+        predictions = []
+        
+        for start in range(0, len(patches), self.batch_size):
+            batch = patches[start:start + self.batch_size]
+            count = len(batch)
+            
+            # Pad the last batch so the traced inference graph is never retraced
+            if count < self.batch_size:
+                padding = np.zeros((self.batch_size - count, *batch.shape[1:]), dtype=batch.dtype)
+                batch = np.concatenate([batch, padding])
+            
+            if self.classifier is not None:
+                batch_predictions = self.classifier.predict(batch)
+            else:
+                batch_predictions = self.model.predict(batch)
+            
+            predictions.append(batch_predictions[:count])
+        
+        if not predictions:
+            return np.empty((0, len(self.cell_classes)), dtype=np.float32)
+        
+        return np.concatenate(predictions)
+    
+    def _patch_batch(self, cell_regions: List[np.ndarray]) -> np.ndarray:
+        """Classifier-ready float32 batch of cell regions; equal to stacking _preprocess_cell_patch.
+        
+        Each region is resized straight into its slot of a reused uint8 buffer,
+        then the whole batch is converted and normalized in one pass, so no
+        per-cell arrays are allocated.
+        """
+        height, width = self.input_shape[:2]
+        count = len(cell_regions)
+        
+        if self._patch_staging is None or len(self._patch_staging) < count:
+            self._patch_staging = np.empty((max(count, self.max_patches_per_step), height, width, 3), dtype=np.uint8)
+        staging = self._patch_staging[:count]
+        
+        for region, slot in zip(cell_regions, staging):
+            cv2.resize(region, (width, height), dst=slot)
+        
+        # A new array: the batcher may hold it after the staging buffer is refilled
+        batch = np.empty(staging.shape, dtype=np.float32)
+        np.divide(staging, np.float32(255.0), out=batch)
+        return batch
+    
     def _preprocess_cell_patch(self, cell_region: np.ndarray) -> np.ndarray:
         """Preprocess individual cell patch for classification"""
         # Resize to EfficientNet input size
-        resized = cv2.resize(cell_region, (224, 224))
+        resized = cv2.resize(cell_region, self.input_shape[:2])
         
         # Normalize pixel values
         normalized = resized.astype(np.float32) / 255.0
         
         return normalized
     
-    async def _calculate_cell_counts(self, predictions: List[np.ndarray]) -> Dict:
+    async def _calculate_cell_counts(self, predictions: List[np.ndarray], fields: float = 1.0) -> Dict:
         """Calculate cell counts and percentages from predictions"""
         if not predictions:
             return await self._get_mock_cell_counts()
@@ -207,8 +456,8 @@ class EfficientNetB0Model:
             'monocytes': int((class_counts[2] / wbc_total * 100)) if wbc_total > 0 else 0,
             'eosinophils': int((class_counts[3] / wbc_total * 100)) if wbc_total > 0 else 0,
             'basophils': int((class_counts[4] / wbc_total * 100)) if wbc_total > 0 else 0,
-            'platelets': int(class_counts[5] * 2000),  # Estimate platelet count
-            'rbcs': int(class_counts[6] * 30000)  # Estimate RBC count
+            'platelets': int(class_counts[5] / fields * 2000),  # Estimate platelet count per field
+            'rbcs': int(class_counts[6] / fields * 30000)  # Estimate RBC count per field
         }
         
         return cell_counts
@@ -0,0 +1,360 @@
+import inspect
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple
+
+import torch
+from transformers import AutoTokenizer, AutoModelForCausalLM, StoppingCriteria, StoppingCriteriaList, TextStreamer
+
+logger = logging.getLogger(__name__)
+
+def _resident_memory_mb() -> float:
+    """Resident set size of this process in MiB"""
+    try:
+        with open("/proc/self/statm") as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError, IndexError):
+        # No procfs: peak RSS is the closest available figure
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+@dataclass
+class PrefixState:
+    """Token ids of a constant prompt prefix and the model's key/value cache for them"""
+    text: str
+    input_ids: torch.Tensor
+    past_key_values: Tuple
+
+    @property
+    def nbytes(self) -> int:
+        tensors = [tensor for layer in self.past_key_values for tensor in layer]
+        return sum(tensor.element_size() * tensor.nelement() for tensor in [self.input_ids, *tensors])
+
+def _legacy_cache(past_key_values) -> Tuple:
+    """Per-layer (key, value) tuples, whichever cache class the model returned"""
+    if hasattr(past_key_values, "to_legacy_cache"):
+        return past_key_values.to_legacy_cache()
+    return past_key_values
+
+def _expand_cache(past_key_values: Tuple, batch_size: int) -> Tuple:
+    """Broadcast a single-row cache to `batch_size` rows without copying"""
+    return tuple(
+        tuple(tensor.expand(batch_size, *tensor.shape[1:]) for tensor in layer)
+        for layer in past_key_values
+    )
+
+class LLMBackend:
+    """Text generation runtime for the explanation model: prompt in, continuation out"""
+
+    name = "base"
+
+    def __init__(self):
+        self.load_report: Dict = {}
+
+    def load(self):
+        raise NotImplementedError
+
+    def generate(self, prompt: str, max_new_tokens: int, temperature: float) -> str:
+        raise NotImplementedError
+
+    def generate_batch(self, prompts: List[str], max_new_tokens: int, temperature: float,
+                       prefix: Optional[PrefixState] = None) -> List[str]:
+        """Continuations for several prompts; runtimes without batching run them in turn.
+
+        `prefix`, from `encode_prefix`, is a precomputed state all prompts start with.
+        """
+        return [self.generate(prompt, max_new_tokens, temperature) for prompt in prompts]
+
+    def stream(self, prompt: str, max_new_tokens: int, temperature: float,
+               on_text: Callable[[str], None], stop: Optional[threading.Event] = None) -> None:
+        """Generate like `generate`, handing each decoded piece of text to `on_text`.
+
+        Generation ends early, after the current token, once `stop` is set.
+        """
+        raise NotImplementedError
+
+    def encode_prefix(self, text: str, base: Optional[PrefixState] = None) -> Optional[PrefixState]:
+        """Attention state for a prompt prefix, extending `base` when `text` starts with it.
+
+        Runtimes without an explicit prefix cache return None.
+        """
+        return None
+
+    def cache_prefix(self, text: str) -> int:
+        """Keep the state of a constant prompt prefix for every later prompt; returns its token count"""
+        return 0
+
+    def _probe(self, prompt: str, max_new_tokens: int) -> int:
+        """Greedy-decode up to `max_new_tokens`; returns the number of tokens produced"""
+        raise NotImplementedError
+
+    def load_and_measure(self, probe_prompt: str = "Blood Cell Differential Count:",
+                         probe_tokens: int = 32) -> Dict:
+        """Load the model, then record load time, memory growth and decode throughput"""
+        memory_before = _resident_memory_mb()
+        start = time.perf_counter()
+        self.load()
+        load_seconds = time.perf_counter() - start
+        memory_mb = _resident_memory_mb() - memory_before
+
+        start = time.perf_counter()
+        generated = self._probe(probe_prompt, probe_tokens)
+        elapsed = time.perf_counter() - start
+
+        self.load_report = {
+            "backend": self.name,
+            "load_seconds": round(load_seconds, 2),
+            "memory_mb": round(memory_mb, 1),
+            "tokens_per_sec": round(generated / elapsed, 2) if elapsed > 0 else 0.0
+        }
+        logger.info(
+            f"LLM backend {self.name} loaded in {self.load_report['load_seconds']}s, "
+            f"{self.load_report['memory_mb']} MiB, {self.load_report['tokens_per_sec']} tokens/s"
+        )
+        return self.load_report
+
+class _CallbackStreamer(TextStreamer):
+    """Passes each finalized piece of decoded text to a callback"""
+
+    def __init__(self, tokenizer, on_text: Callable[[str], None]):
+        super().__init__(tokenizer, skip_prompt=True, skip_special_tokens=True)
+        self.on_text = on_text
+
+    def on_finalized_text(self, text: str, stream_end: bool = False):
+        if text:
+            self.on_text(text)
+
+class _StopOnEvent(StoppingCriteria):
+    """Ends generation once an event is set, e.g. when the client has gone away"""
+
+    def __init__(self, event: threading.Event):
+        self.event = event
+
+    def __call__(self, input_ids, scores, **kwargs) -> bool:
+        return self.event.is_set()
+
+class TransformersBackend(LLMBackend):
+    """Hugging Face causal LM: float16 on GPU, float32 on CPU"""
+
+    name = "transformers"
+
+    def __init__(self, model_name: str, num_threads: int = 0):
+        super().__init__()
+        self.model_name = model_name
+        self.num_threads = num_threads
+        self.model = None
+        self.tokenizer = None
+        self._prefixes: Dict[str, PrefixState] = {}
+        self._takes_position_ids = False
+
+    def load(self):
+        if self.num_threads:
+            torch.set_num_threads(self.num_threads)
+
+        self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+        # Batched prompts are left-padded so every continuation starts at the same column
+        self.tokenizer.padding_side = "left"
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.model = self._load_model()
+        self.model.eval()
+        self._takes_position_ids = "position_ids" in inspect.signature(self.model.forward).parameters
+
+    def _load_model(self):
+        # Half precision only pays off on GPU; CPU float16 kernels are slow or missing
+        if torch.cuda.is_available():
+            return AutoModelForCausalLM.from_pretrained(
+                self.model_name, torch_dtype=torch.float16, device_map="auto"
+            )
+        return AutoModelForCausalLM.from_pretrained(
+            self.model_name, torch_dtype=torch.float32, low_cpu_mem_usage=True
+        )
+
+    def _encode(self, prompts: List[str]):
+        inputs = self.tokenizer(prompts, return_tensors="pt", padding=True, return_token_type_ids=False)
+        return inputs.to(self.model.device)
+
+    def _generate_ids(self, inputs, max_new_tokens: int, temperature: Optional[float] = None,
+                      streamer=None, stop: Optional[threading.Event] = None):
+        """model.generate; sampling at `temperature`, or greedy when it is None"""
+        sampling = {"do_sample": True, "temperature": temperature} if temperature else {"do_sample": False}
+        stopping_criteria = StoppingCriteriaList([_StopOnEvent(stop)]) if stop is not None else None
+
+        with torch.no_grad():
+            return self.model.generate(
+                **inputs,
+                max_new_tokens=max_new_tokens,
+                pad_token_id=self.tokenizer.pad_token_id,
+                streamer=streamer,
+                stopping_criteria=stopping_criteria,
+                **sampling
+            )
+
+    def encode_prefix(self, text: str, base: Optional[PrefixState] = None) -> Optional[PrefixState]:
+        if base is None or not text.startswith(base.text):
+            base = self._matching_prefix([text])
+        if base is not None and text == base.text:
+            return base
+
+        if base is None:
+            input_ids = self.tokenizer(text, return_tensors="pt", return_token_type_ids=False)["input_ids"]
+            input_ids, base_length, past_key_values = input_ids.to(self.model.device), 0, None
+        else:
+            # Only the text after `base` is run through the model
+            extension = self.tokenizer(
+                text[len(base.text):], return_tensors="pt", add_special_tokens=False, return_token_type_ids=False
+            )["input_ids"].to(self.model.device)
+            input_ids = torch.cat([base.input_ids, extension], dim=1)
+            base_length, past_key_values = base.input_ids.shape[1], base.past_key_values
+
+        with torch.no_grad():
+            output = self.model(
+                input_ids=input_ids[:, base_length:], past_key_values=past_key_values, use_cache=True
+            )
+
+        return PrefixState(text, input_ids, _legacy_cache(output.past_key_values))
+
+    def cache_prefix(self, text: str) -> int:
+        state = self.encode_prefix(text)
+        self._prefixes[text] = state
+        return state.input_ids.shape[1]
+
+    def _matching_prefix(self, prompts: List[str]) -> Optional[PrefixState]:
+        """Longest cached prefix shared by every prompt, if any"""
+        for text in sorted(self._prefixes, key=len, reverse=True):
+            if all(prompt.startswith(text) and len(prompt) > len(text) for prompt in prompts):
+                return self._prefixes[text]
+        return None
+
+    def _prepare(self, prompts: List[str], prefix: Optional[PrefixState] = None) -> Dict:
+        """generate() inputs, reusing the key/value cache of `prefix` or a matching cached one"""
+        if prefix is None:
+            prefix = self._matching_prefix(prompts)
+        if prefix is None:
+            return dict(self._encode(prompts))
+
+        suffix = self.tokenizer(
+            [prompt[len(prefix.text):] for prompt in prompts],
+            return_tensors="pt", padding=True, add_special_tokens=False, return_token_type_ids=False
+        ).to(self.model.device)
+
+        # Rows are [prefix][padding][suffix]; the mask hides the padding and
+        # positions follow the mask, so each row reads as one contiguous prompt
+        batch_size, prefix_length = len(prompts), prefix.input_ids.shape[1]
+        prefix_ids = prefix.input_ids.expand(batch_size, -1)
+        input_ids = torch.cat([prefix_ids, suffix["input_ids"]], dim=1)
+        attention_mask = torch.cat([torch.ones_like(prefix_ids), suffix["attention_mask"]], dim=1)
+        past_key_values = _expand_cache(prefix.past_key_values, batch_size)
+
+        # Prefill all but the last suffix token; generate() feeds that one itself
+        if input_ids.shape[1] - prefix_length > 1:
+            forward_inputs = {
+                "input_ids": input_ids[:, prefix_length:-1],
+                "attention_mask": attention_mask[:, :-1],
+                "past_key_values": past_key_values,
+                "use_cache": True
+            }
+            if self._takes_position_ids:
+                positions = (attention_mask.cumsum(dim=1) - 1).clamp(min=0)
+                forward_inputs["position_ids"] = positions[:, prefix_length:-1]
+
+            with torch.no_grad():
+                past_key_values = _legacy_cache(self.model(**forward_inputs).past_key_values)
+
+        return {"input_ids": input_ids, "attention_mask": attention_mask, "past_key_values": past_key_values}
+
+    def generate(self, prompt: str, max_new_tokens: int, temperature: float) -> str:
+        return self.generate_batch([prompt], max_new_tokens, temperature)[0]
+
+    def generate_batch(self, prompts: List[str], max_new_tokens: int, temperature: float,
+                       prefix: Optional[PrefixState] = None) -> List[str]:
+        inputs = self._prepare(prompts, prefix)
+        output = self._generate_ids(inputs, max_new_tokens, temperature)
+        prompt_length = inputs["input_ids"].shape[1]
+        return [
+            self.tokenizer.decode(row[prompt_length:], skip_special_tokens=True).strip()
+            for row in output
+        ]
+
+    def stream(self, prompt: str, max_new_tokens: int, temperature: float,
+               on_text: Callable[[str], None], stop: Optional[threading.Event] = None) -> None:
+        streamer = _CallbackStreamer(self.tokenizer, on_text)
+        self._generate_ids(self._prepare([prompt]), max_new_tokens, temperature, streamer=streamer, stop=stop)
+
+    def _probe(self, prompt: str, max_new_tokens: int) -> int:
+        inputs = self._encode([prompt])
+        output = self._generate_ids(inputs, max_new_tokens)
+        return output.shape[1] - inputs["input_ids"].shape[1]
+
+class QuantizedTransformersBackend(TransformersBackend):
+    """CPU model whose Linear layers hold int8 weights, with activations quantized per call"""
+
+    name = "int8"
+
+    def _load_model(self):
+        model = AutoModelForCausalLM.from_pretrained(
+            self.model_name, torch_dtype=torch.float32, low_cpu_mem_usage=True
+        )
+        # In place, so the float32 Linear weights are released once converted
+        return torch.ao.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+        )
+
+class LlamaCppBackend(LLMBackend):
+    """GGUF-quantized model (e.g. Q4_K_M or Q8_0) run by llama.cpp"""
+
+    name = "gguf"
+
+    def __init__(self, model_path: str, num_threads: int = 0, context_length: int = 2048):
+        super().__init__()
+        self.model_path = model_path
+        self.num_threads = num_threads
+        self.context_length = context_length
+        self.llm = None
+
+    def load(self):
+        # Optional dependency; only needed when this backend is selected
+        from llama_cpp import Llama
+
+        self.llm = Llama(
+            model_path=self.model_path,
+            n_ctx=self.context_length,
+            n_threads=self.num_threads or None,
+            verbose=False
+        )
+
+    def generate(self, prompt: str, max_new_tokens: int, temperature: float) -> str:
+        response = self.llm(prompt, max_tokens=max_new_tokens, temperature=temperature)
+        return response["choices"][0]["text"].strip()
+
+    def stream(self, prompt: str, max_new_tokens: int, temperature: float,
+               on_text: Callable[[str], None], stop: Optional[threading.Event] = None) -> None:
+        for chunk in self.llm(prompt, max_tokens=max_new_tokens, temperature=temperature, stream=True):
+            # Leaving the loop closes the generator, which ends llama.cpp's decode
+            if stop is not None and stop.is_set():
+                break
+            text = chunk["choices"][0]["text"]
+            if text:
+                on_text(text)
+
+    def _probe(self, prompt: str, max_new_tokens: int) -> int:
+        response = self.llm(prompt, max_tokens=max_new_tokens, temperature=0.0)
+        return response["usage"]["completion_tokens"]
+
+def create_llm_backend(backend: str, model_name: str, gguf_path: Optional[str] = None,
+                       num_threads: int = 0) -> LLMBackend:
+    """Instantiate the configured backend; the model is loaded by `load_and_measure`"""
+    if backend == TransformersBackend.name:
+        return TransformersBackend(model_name, num_threads)
+    if backend == QuantizedTransformersBackend.name:
+        return QuantizedTransformersBackend(model_name, num_threads)
+    if backend == LlamaCppBackend.name:
+        if not gguf_path:
+            raise ValueError("The gguf backend needs the path of a GGUF model file")
+        return LlamaCppBackend(gguf_path, num_threads)
+
+    raise ValueError(f"Unknown LLM backend: {backend}")
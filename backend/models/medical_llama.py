@@ -1,69 +1,147 @@
 import asyncio
+import hashlib
 import logging
-from typing import Dict, Any
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import AsyncIterator, Dict, Any, List, Optional
 from datetime import datetime
-import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM, pipeline
 import json
 
+from models.llm_backends import LLMBackend, create_llm_backend
+from services.generation_batcher import GenerationBatcher
+from services.conversation_cache import ConversationCache, ConversationSession
+
 logger = logging.getLogger(__name__)
 
+# Constant opening of every prompt. Keeping the instructions ahead of the
+# variable findings lets the backend compute their attention state once.
+EXPLANATION_PREFIX = """As a medical AI assistant specializing in hematology, analyze the following blood cell analysis results and provide a comprehensive medical explanation.
+
+Please provide a detailed medical interpretation including:
+1. Analysis of the white blood cell differential
+2. Assessment of red blood cell and platelet counts
+3. Clinical significance of findings
+4. Potential underlying conditions
+5. Recommended follow-up actions
+
+"""
+
+FOLLOW_UP_PREFIX = """As a medical AI assistant specializing in hematology, answer the patient's question about their blood analysis results clearly and accurately.
+
+"""
+
 class MedicalLLaMA:
     """Medical LLaMA model for generating medical explanations and insights"""
     
-    def __init__(self):
-        self.model = None
-        self.tokenizer = None
-        self.text_generator = None
+    def __init__(self, cache=None, cache_size: int = 1000, backend: str = "transformers",
+                 gguf_path: Optional[str] = None, num_threads: int = 0,
+                 max_batch_size: int = 8, max_wait_ms: float = 50.0,
+                 session_ttl_seconds: float = 1800.0, session_memory_mb: int = 512,
+                 follow_up_turns: int = 2):
+        self.generator: Optional[LLMBackend] = None
+        self.batcher: Optional[GenerationBatcher] = None
         self.model_name = "microsoft/BioGPT-Large"  # Alternative: medical-focused model
         
+        # Runtime selection: transformers, int8 (dynamic quantization) or gguf (llama.cpp)
+        self.backend = backend
+        self.gguf_path = gguf_path
+        self.num_threads = num_threads
+        self.load_report: Dict[str, Any] = {}
+        
+        # Generation runs on its own thread so a slow explanation never blocks the event loop
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="llm")
+        
+        # Concurrent non-streaming requests are generated together in padded batches
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        
+        # Follow-up conversations keep their context and model state warm between questions
+        self.sessions = ConversationCache(session_ttl_seconds, session_memory_mb * 2 ** 20)
+        self.follow_up_turns = follow_up_turns
+        
+        # Optional persistent LRU of generated explanations (a Database)
+        self.cache = cache
+        self.cache_size = cache_size
+        
+        # Load state reported by /ready; requests wait on _loaded
+        self.load_state = "not_loaded"
+        self._loaded = asyncio.Event()
+        
     async def load_model(self):
-        """Load the medical language model"""
+        """Load the medical language model on the generation thread"""
+        self.load_state = "loading"
+        
         try:
-            logger.info("Loading Medical LLaMA model...")
+            logger.info(f"Loading Medical LLaMA model ({self.backend} backend)...")
             
-            # Load tokenizer and model
-            self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
-            self.model = AutoModelForCausalLM.from_pretrained(
-                self.model_name,
-                torch_dtype=torch.float16,
-                device_map="auto" if torch.cuda.is_available() else None
+            generator = create_llm_backend(self.backend, self.model_name, self.gguf_path, self.num_threads)
+            
+            loop = asyncio.get_running_loop()
+            self.load_report = await loop.run_in_executor(self._executor, generator.load_and_measure)
+            self.load_report["cached_prefix_tokens"] = await loop.run_in_executor(
+                self._executor, self._cache_prefixes, generator
             )
+            self.generator = generator
             
-            # Create text generation pipeline
-            self.text_generator = pipeline(
-                "text-generation",
-                model=self.model,
-                tokenizer=self.tokenizer,
-                max_length=1024,
-                temperature=0.7,
-                do_sample=True,
-                pad_token_id=self.tokenizer.eos_token_id
+            self.batcher = GenerationBatcher(
+                generator.generate_batch, self._executor,
+                max_batch_size=self.max_batch_size, max_wait_ms=self.max_wait_ms
             )
+            self.batcher.start()
             
+            self.load_state = "ready"
             logger.info("Medical LLaMA model loaded successfully")
             
         except Exception as e:
             logger.error(f"Error loading Medical LLaMA model: {str(e)}")
             # Use mock responses for demo
-            self.text_generator = None
+            self.generator = None
+            self.load_state = "failed"
+        
+        finally:
+            self._loaded.set()
+    
+    def _cache_prefixes(self, generator: LLMBackend) -> int:
+        """Prefill the constant prompt openings once so requests only pay for their findings"""
+        try:
+            return sum(generator.cache_prefix(prefix) for prefix in (EXPLANATION_PREFIX, FOLLOW_UP_PREFIX))
+        except Exception as e:
+            logger.warning(f"Prompt prefix caching unavailable: {str(e)}")
+            return 0
+    
+    async def wait_until_loaded(self):
+        """Block until loading finished, successfully or with the mock fallback"""
+        await self._loaded.wait()
+    
+    async def shutdown(self):
+        """Stop batching and release the generation thread"""
+        if self.batcher:
+            await self.batcher.stop()
+        self._executor.shutdown(wait=False)
     
     async def generate_explanation(self, analysis_results: Dict) -> str:
         """Generate comprehensive medical explanation based on analysis results"""
+        await self.wait_until_loaded()
+        
         try:
             # Create medical prompt
             prompt = await self._create_medical_prompt(analysis_results)
             
-            if self.text_generator:
+            if self.generator:
+                # Equivalent findings produce the same prompt, so reuse its explanation
+                prompt_key = self._prompt_key(prompt)
+                if self.cache:
+                    cached = await self.cache.get_cached_explanation(prompt_key)
+                    if cached:
+                        logger.info("Medical explanation served from cache")
+                        return cached
+                
                 # Generate explanation using the model
-                response = self.text_generator(
-                    prompt,
-                    max_length=800,
-                    num_return_sequences=1,
-                    temperature=0.7
-                )
+                explanation = await self._generate(prompt, max_new_tokens=512, temperature=0.7)
                 
-                explanation = response[0]['generated_text'].replace(prompt, "").strip()
+                if self.cache and explanation:
+                    await self.cache.save_cached_explanation(prompt_key, explanation, self.cache_size)
                 
             else:
                 # Use mock explanation for demo
@@ -75,16 +153,74 @@ class MedicalLLaMA:
             logger.error(f"Error generating medical explanation: {str(e)}")
             return await self._generate_mock_explanation(analysis_results)
     
+    async def stream_explanation(self, analysis_results: Dict) -> AsyncIterator[str]:
+        """Yield the medical explanation incrementally as tokens are generated"""
+        await self.wait_until_loaded()
+        prompt = await self._create_medical_prompt(analysis_results)
+        
+        if not self.generator:
+            yield await self._generate_mock_explanation(analysis_results)
+            return
+        
+        prompt_key = self._prompt_key(prompt)
+        if self.cache:
+            cached = await self.cache.get_cached_explanation(prompt_key)
+            if cached:
+                logger.info("Medical explanation served from cache")
+                yield cached
+                return
+        
+        # Text produced on the generation thread is handed to the event loop in order;
+        # the None sentinel is queued only after the last piece
+        loop = asyncio.get_running_loop()
+        pieces: asyncio.Queue = asyncio.Queue()
+        stop = threading.Event()
+        
+        generation = loop.run_in_executor(self._executor, partial(
+            self.generator.stream, prompt,
+            max_new_tokens=512,
+            temperature=0.7,
+            on_text=lambda text: loop.call_soon_threadsafe(pieces.put_nowait, text),
+            stop=stop
+        ))
+        generation.add_done_callback(lambda _: pieces.put_nowait(None))
+        
+        chunks = []
+        try:
+            while (text := await pieces.get()) is not None:
+                chunks.append(text)
+                yield text
+            
+            await generation
+        finally:
+            # A disconnected client cancels this generator or closes it early; end the
+            # generation after its current token so it stops holding the LLM thread
+            if not generation.done():
+                stop.set()
+                logger.info("Explanation stream closed early, stopping generation")
+        
+        explanation = "".join(chunks).strip()
+        if self.cache and explanation:
+            await self.cache.save_cached_explanation(prompt_key, explanation, self.cache_size)
+    
+    async def _generate(self, prompt: str, max_new_tokens: int, temperature: float) -> str:
+        """Generate through the batcher, sharing a forward pass with concurrent requests"""
+        return await self.batcher.generate(prompt, max_new_tokens, temperature)
+    
+    def _prompt_key(self, prompt: str) -> str:
+        """Canonical hash of a prompt for the model that answers it"""
+        canonical = " ".join(prompt.split())
+        return hashlib.sha256(f"{self.model_name}/{self.backend}\n{canonical}".encode()).hexdigest()
+    
     async def _create_medical_prompt(self, results: Dict) -> str:
         """Create a structured medical prompt for the LLaMA model"""
         
         cell_counts = results.get('cell_counts', {})
         diseases = results.get('diseases', [])
-        abnormalities = results.get('abnormalities', [])
+        # Sorted so equivalent findings always yield an identical prompt
+        abnormalities = sorted(results.get('abnormalities', []))
         
-        prompt = f"""As a medical AI assistant specializing in hematology, analyze the following blood cell analysis results and provide a comprehensive medical explanation:
-
-Blood Cell Differential Count:
+        prompt = f"""{EXPLANATION_PREFIX}Blood Cell Differential Count:
 - Neutrophils: {cell_counts.get('neutrophils', 0)}%
 - Lymphocytes: {cell_counts.get('lymphocytes', 0)}%
 - Monocytes: {cell_counts.get('monocytes', 0)}%
@@ -101,13 +237,6 @@ Detected Abnormalities:
 Potential Conditions Identified:
 {chr(10).join(f"- {disease['name']} (confidence: {disease['confidence']}%)" for disease in diseases)}
 
-Please provide a detailed medical interpretation including:
-1. Analysis of the white blood cell differential
-2. Assessment of red blood cell and platelet counts
-3. Clinical significance of findings
-4. Potential underlying conditions
-5. Recommended follow-up actions
-
 Medical Interpretation:"""
 
         return prompt
@@ -163,9 +292,9 @@ Advanced computer vision analysis has identified the following cellular characte
 
 2. **Follow-up Testing:** {'Consider additional laboratory studies including blood culture, inflammatory markers (ESR, CRP), and comprehensive metabolic panel if clinical symptoms suggest infection.' if neutrophils > 70 else 'Routine monitoring may be sufficient given normal parameters.' if 50 <= neutrophils <= 70 else 'Consider viral studies and autoimmune markers if clinical presentation warrants.'}
 
-3. **Monitoring Protocol:** {'Serial blood counts over 24-48 hours to monitor response to treatment if infection is suspected.' if neutrophils > 70 else 'Repeat complete blood count in 3-6 months as part of routine health maintenance.' if all(150000 <= platelets <= 450000 and 4200000 <= rbcs <= 5400000) else 'Follow-up blood work in 2-4 weeks to assess for improvement or progression.'}
+3. **Monitoring Protocol:** {'Serial blood counts over 24-48 hours to monitor response to treatment if infection is suspected.' if neutrophils > 70 else 'Repeat complete blood count in 3-6 months as part of routine health maintenance.' if 150000 <= platelets <= 450000 and 4200000 <= rbcs <= 5400000 else 'Follow-up blood work in 2-4 weeks to assess for improvement or progression.'}
 
-4. **Specialist Consultation:** {'Infectious disease consultation may be warranted if fever or signs of systemic infection are present.' if neutrophils > 75 else 'Hematology referral recommended if abnormal findings persist on repeat testing.' if any(not (50 <= neutrophils <= 70 and 20 <= lymphocytes <= 40)) else 'No immediate specialist referral required based on current findings.'}
+4. **Specialist Consultation:** {'Infectious disease consultation may be warranted if fever or signs of systemic infection are present.' if neutrophils > 75 else 'Hematology referral recommended if abnormal findings persist on repeat testing.' if not (50 <= neutrophils <= 70 and 20 <= lymphocytes <= 40) else 'No immediate specialist referral required based on current findings.'}
 
 **Quality Assurance Notes:**
 This analysis was performed using EfficientNet B0 deep learning architecture for cellular classification with {results.get('confidence_scores', {}).get('overall', 0.94)*100:.1f}% overall confidence. The medical interpretation was generated using advanced medical language models trained on extensive hematological literature and clinical data.
@@ -175,28 +304,27 @@ This AI-generated analysis serves as a diagnostic aid and should not replace cli
 
         return explanation
     
-    async def answer_follow_up_question(self, question: str, analysis_results: Dict) -> str:
-        """Answer follow-up questions about the analysis"""
+    async def answer_follow_up_question(self, question: str, analysis_results: Dict,
+                                        analysis_id: Optional[str] = None,
+                                        history: Optional[List[Dict]] = None) -> str:
+        """Answer follow-up questions about the analysis.
+        
+        With an `analysis_id`, earlier turns in `history` are part of the context and the
+        context's model state is kept in that analysis's conversation session.
+        """
+        await self.wait_until_loaded()
+        
         try:
             # Create context-aware prompt
-            context_prompt = f"""Based on the blood analysis results showing:
-- Neutrophils: {analysis_results.get('cell_counts', {}).get('neutrophils', 0)}%
-- Lymphocytes: {analysis_results.get('cell_counts', {}).get('lymphocytes', 0)}%
-- Other findings: {', '.join(analysis_results.get('abnormalities', []))}
-
-Patient Question: {question}
+            context = self._follow_up_context(analysis_results, history or [])
+            context_prompt = f"""{context}Patient Question: {question}
 
 Medical Response:"""
 
-            if self.text_generator:
-                response = self.text_generator(
-                    context_prompt,
-                    max_length=300,
-                    num_return_sequences=1,
-                    temperature=0.6
-                )
-                
-                answer = response[0]['generated_text'].replace(context_prompt, "").strip()
+            if self.generator and analysis_id:
+                answer = await self._generate_in_session(analysis_id, context, context_prompt)
+            elif self.generator:
+                answer = await self._generate(context_prompt, max_new_tokens=200, temperature=0.6)
             else:
                 answer = await self._generate_mock_answer(question, analysis_results)
             
@@ -206,6 +334,54 @@ Medical Response:"""
             logger.error(f"Error answering follow-up question: {str(e)}")
             return "I apologize, but I'm unable to process your question at the moment. Please consult with your healthcare provider for specific medical advice."
     
+    def _follow_up_context(self, results: Dict, history: List[Dict]) -> str:
+        """Preamble, findings and the latest conversation turns that precede a question"""
+        cell_counts = results.get('cell_counts', {})
+        
+        context = f"""{FOLLOW_UP_PREFIX}Based on the blood analysis results showing:
+- Neutrophils: {cell_counts.get('neutrophils', 0)}%
+- Lymphocytes: {cell_counts.get('lymphocytes', 0)}%
+- Other findings: {', '.join(results.get('abnormalities', []))}
+
+"""
+        # Older turns are dropped to stay within the model's context window, a whole
+        # block at a time: the window keeps its first turn until it would exceed
+        # follow_up_turns, so the context only grows and the session state is reused
+        if self.follow_up_turns > 0 and history:
+            recent_turns = history[(len(history) - 1) // self.follow_up_turns * self.follow_up_turns:]
+        else:
+            recent_turns = []
+        for turn in recent_turns:
+            context += f"""Patient Question: {turn['question']}
+
+Medical Response: {turn['answer']}
+
+"""
+        return context
+    
+    async def _generate_in_session(self, analysis_id: str, context: str, prompt: str) -> str:
+        """Answer from the analysis's warm conversation state, extending it to `context` first"""
+        loop = asyncio.get_running_loop()
+        session = self.sessions.get(analysis_id, context)
+        
+        if session is None or session.context != context:
+            # Only the turns added since the session was stored are prefilled
+            state = await loop.run_in_executor(
+                self._executor, self.generator.encode_prefix, context, session.state if session else None
+            )
+            session = ConversationSession(analysis_id, context, state)
+            self.sessions.put(session)
+        
+        if session.state is None:
+            # Runtime without reusable prefix state; generate like any other prompt
+            return await self._generate(prompt, max_new_tokens=200, temperature=0.6)
+        
+        # A session's state is specific to one conversation, so it is not batched
+        answers = await loop.run_in_executor(self._executor, partial(
+            self.generator.generate_batch, [prompt], 200, 0.6, prefix=session.state
+        ))
+        return answers[0]
+    
     async def _generate_mock_answer(self, question: str, results: Dict) -> str:
         """Generate mock answers for common follow-up questions"""
         
@@ -0,0 +1,160 @@
+import hashlib
+import json
+import logging
+from typing import Awaitable, Callable, Dict, Optional
+
+from database import Database, AnalysisResult
+
+logger = logging.getLogger(__name__)
+
+class AnalysisPipeline:
+    """Complete blood cell analysis: preprocessing, classification and disease detection"""
+
+    def __init__(self, image_processor, efficientnet_model, analysis_service, db: Database,
+                 tiled_detector=None):
+        self.image_processor = image_processor
+        self.efficientnet_model = efficientnet_model
+        self.analysis_service = analysis_service
+        self.db = db
+        self.tiled_detector = tiled_detector  # Optional TiledCellDetector for large images
+
+    async def perform_analysis(self, analysis_id: str, image_path: str,
+                               report: Callable[[Dict], Awaitable[None]],
+                               image_hash: Optional[str] = None) -> None:
+        """Run the analysis for one image, reporting each stage through `report`.
+        
+        `image_hash` is the SHA-256 of the uploaded file, computed while it was streamed to disk.
+        """
+
+        try:
+            # Identical image under an identical pipeline: reuse the stored result
+            cache_key = self.cache_key(image_hash) if image_hash else None
+            if cache_key and await self._reuse_cached_result(analysis_id, image_path, cache_key, report):
+                return
+            
+            # Update progress: Image preprocessing
+            await report({
+                "status": "preprocessing",
+                "progress": 20,
+                "stage": "Preprocessing image..."
+            })
+
+            tiled = self.tiled_detector is not None and self.image_processor.use_tiled_analysis(image_path)
+
+            if tiled:
+                # Large smear: preprocess and detect cells tile by tile at full resolution
+                cell_regions, fields = await self.tiled_detector.detect(image_path)
+            else:
+                # Preprocess image
+                processed_image = await self.image_processor.preprocess_image(image_path, image_hash)
+                # Counts are normalized by the canvas area the image covers, as on the tiled path
+                fields = self.image_processor.image_fields(image_path)
+
+            # Update progress: EfficientNet analysis
+            await report({
+                "status": "analyzing",
+                "progress": 40,
+                "stage": "EfficientNet B0 analysis..."
+            })
+
+            # Perform EfficientNet B0 analysis
+            if tiled:
+                cell_analysis = await self.efficientnet_model.analyze_regions(cell_regions, fields)
+            else:
+                cell_analysis = await self.efficientnet_model.analyze_cells(processed_image, fields)
+
+            # Update progress: Disease detection
+            await report({
+                "status": "detecting",
+                "progress": 70,
+                "stage": "Disease detection..."
+            })
+
+            # Perform disease detection
+            disease_results = await self.analysis_service.detect_diseases(cell_analysis)
+
+            # Update progress: Finalizing
+            await report({
+                "status": "finalizing",
+                "progress": 90,
+                "stage": "Finalizing results..."
+            })
+
+            # Prepare final results
+            final_results = {
+                "analysis_id": analysis_id,
+                "cell_counts": cell_analysis["cell_counts"],
+                "diseases": disease_results["diseases"],
+                "abnormalities": disease_results["abnormalities"],
+                "confidence_scores": cell_analysis["confidence_scores"],
+                "image_path": image_path,
+                "timestamp": cell_analysis["timestamp"]
+            }
+
+            # Save to database
+            if not await self.db.save_analysis_result(AnalysisResult(**final_results)):
+                raise RuntimeError("Could not save analysis result")
+            
+            if cache_key:
+                await self.db.save_cached_analysis_id(cache_key, analysis_id)
+
+            # Update progress: Complete
+            await report({
+                "status": "completed",
+                "progress": 100,
+                "stage": "Analysis completed successfully!"
+            })
+
+            logger.info(f"Analysis {analysis_id} completed successfully")
+
+        except Exception as e:
+            # The job queue decides whether the analysis is retried
+            logger.error(f"Error in analysis {analysis_id}: {str(e)}")
+            raise
+
+    def cache_key(self, image_hash: str) -> str:
+        """Content-addressed key: image bytes, model version and pipeline configuration"""
+        fingerprint = json.dumps({
+            "image": image_hash,
+            "model": self.efficientnet_model.model_version,
+            "backend": self.efficientnet_model.backend,
+            "detection_field": self.efficientnet_model.detection_field,
+            "count_area": "occupied_canvas",
+            "preprocessing": self.image_processor.config(),
+            "disease_patterns": self.analysis_service.disease_patterns,
+            "normal_ranges": self.analysis_service.normal_ranges
+        }, sort_keys=True)
+
+        return hashlib.sha256(fingerprint.encode()).hexdigest()
+
+    async def _reuse_cached_result(self, analysis_id: str, image_path: str, cache_key: str,
+                                   report: Callable[[Dict], Awaitable[None]]) -> bool:
+        """Copy a previously stored result to this analysis; False on a cache miss"""
+        source_id = await self.db.get_cached_analysis_id(cache_key)
+        cached = await self.db.get_analysis_result(source_id) if source_id else None
+
+        if not cached:
+            await self.db.increment_counter("result_cache_misses")
+            return False
+
+        result = AnalysisResult(
+            analysis_id=analysis_id,
+            cell_counts=cached["cell_counts"],
+            diseases=cached["diseases"],
+            abnormalities=cached["abnormalities"],
+            confidence_scores=cached["confidence_scores"],
+            image_path=image_path,
+            timestamp=cached["timestamp"]
+        )
+        if not await self.db.save_analysis_result(result):
+            raise RuntimeError("Could not save analysis result")
+
+        await self.db.increment_counter("result_cache_hits")
+        await report({
+            "status": "completed",
+            "progress": 100,
+            "stage": "Analysis completed successfully! (cached result)"
+        })
+
+        logger.info(f"Analysis {analysis_id} served from cached analysis {source_id}")
+        return True
@@ -0,0 +1,86 @@
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class ConversationSession:
+    """Follow-up context of one analysis and the model state that covers it"""
+    analysis_id: str
+    context: str
+    state: Optional[Any] = None
+    last_used: float = field(default_factory=time.monotonic)
+
+    @property
+    def nbytes(self) -> int:
+        return self.state.nbytes if self.state is not None else len(self.context.encode())
+
+class ConversationCache:
+    """Per-analysis follow-up sessions kept warm for a TTL, LRU-evicted under a memory budget"""
+
+    def __init__(self, ttl_seconds: float = 1800.0, max_bytes: int = 512 * 2 ** 20):
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self._sessions: "OrderedDict[str, ConversationSession]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, analysis_id: str, context: str) -> Optional[ConversationSession]:
+        """The session for `analysis_id` if it is live and its context is a prefix of `context`"""
+        self._expire()
+        session = self._sessions.get(analysis_id)
+
+        if session is None or not context.startswith(session.context):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        session.last_used = time.monotonic()
+        self._sessions.move_to_end(analysis_id)
+        return session
+
+    def put(self, session: ConversationSession) -> None:
+        """Store or replace a session, evicting least recently used ones over budget"""
+        self.pop(session.analysis_id)
+
+        if session.nbytes > self.max_bytes:
+            logger.warning(f"Follow-up state for {session.analysis_id} exceeds the session memory budget")
+            return
+
+        self._sessions[session.analysis_id] = session
+        self._bytes += session.nbytes
+
+        while self._bytes > self.max_bytes:
+            analysis_id, _ = next(iter(self._sessions.items()))
+            self.pop(analysis_id)
+            logger.info(f"Evicted follow-up session {analysis_id}")
+
+    def pop(self, analysis_id: str) -> Optional[ConversationSession]:
+        """Drop the session of an analysis"""
+        session = self._sessions.pop(analysis_id, None)
+        if session is not None:
+            self._bytes -= session.nbytes
+        return session
+
+    def _expire(self):
+        cutoff = time.monotonic() - self.ttl_seconds
+        while self._sessions:
+            analysis_id, session = next(iter(self._sessions.items()))
+            if session.last_used >= cutoff:
+                break
+            self.pop(analysis_id)
+
+    def stats(self) -> Dict:
+        """Session count, memory use and hit/miss counters"""
+        self._expire()
+        return {
+            "sessions": len(self._sessions),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses
+        }
@@ -0,0 +1,104 @@
+import asyncio
+from concurrent.futures import Executor
+from functools import partial
+from typing import Callable, Dict, List, Optional, Tuple
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+GenerateBatchFn = Callable[[List[str], int, float], List[str]]
+
+class GenerationBatcher:
+    """Coalesces concurrent text generation requests into padded batches"""
+
+    def __init__(self, generate_batch_fn: GenerateBatchFn, executor: Executor,
+                 max_batch_size: int = 8, max_wait_ms: float = 50.0):
+        self.generate_batch_fn = generate_batch_fn
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+
+    def start(self):
+        """Start the background batching loop on the running event loop"""
+        if self._worker is None:
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+            logger.info(f"Generation batcher started (max batch: {self.max_batch_size}, max wait: {self.max_wait * 1000:.0f} ms)")
+
+    async def stop(self):
+        """Stop the batching loop"""
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+
+    async def generate(self, prompt: str, max_new_tokens: int, temperature: float) -> str:
+        """Queue a prompt and wait for its continuation"""
+        loop = asyncio.get_running_loop()
+
+        if self._worker is None:
+            # Batcher not running; generate this prompt on its own
+            results = await loop.run_in_executor(
+                self.executor, partial(self.generate_batch_fn, [prompt], max_new_tokens, temperature)
+            )
+            return results[0]
+
+        future = loop.create_future()
+        await self._queue.put((prompt, (max_new_tokens, temperature), future))
+        return await future
+
+    async def _run(self):
+        """Collect pending requests into batches capped by size or wait time.
+
+        While one batch is generating, new requests accumulate in the queue and
+        form the next batch as soon as the model is free.
+        """
+        while True:
+            pending = [await self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+
+            while len(pending) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout=remaining)
+                except asyncio.TimeoutError:
+                    break
+                pending.append(item)
+
+            # One generate call takes a single length limit and temperature
+            groups: Dict[Tuple[int, float], List] = {}
+            for item in pending:
+                groups.setdefault(item[1], []).append(item)
+
+            for settings, items in groups.items():
+                await self._dispatch(settings, items)
+
+    async def _dispatch(self, settings: Tuple[int, float], pending: List[Tuple[str, Tuple, asyncio.Future]]):
+        """Generate one batch on the executor and resolve each caller's future"""
+        max_new_tokens, temperature = settings
+        prompts = [prompt for prompt, _, _ in pending]
+
+        try:
+            start = time.perf_counter()
+            results = await asyncio.get_running_loop().run_in_executor(
+                self.executor, partial(self.generate_batch_fn, prompts, max_new_tokens, temperature)
+            )
+            logger.info(f"Generated batch of {len(prompts)} prompts in {time.perf_counter() - start:.1f}s")
+        except Exception as e:
+            logger.error(f"Error in batched generation: {str(e)}")
+            for _, _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, _, future), result in zip(pending, results):
+            if not future.done():
+                future.set_result(result)
@@ -0,0 +1,219 @@
+import cv2
+import numpy as np
+import math
+import threading
+from pathlib import Path
+import logging
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+TIFF_SUFFIXES = {".tif", ".tiff", ".svs", ".btf"}
+
+# EXIF orientation tag, and the orientations that swap width and height
+EXIF_ORIENTATION = 0x0112
+TRANSPOSED_ORIENTATIONS = {5, 6, 7, 8}
+
+def _to_bgr(region: np.ndarray) -> np.ndarray:
+    """Convert a decoded RGB/RGBA/grayscale region of any integer depth to 8-bit BGR"""
+    if region.dtype == np.uint16:
+        region = (region >> 8).astype(np.uint8)
+    elif region.dtype != np.uint8:
+        raise ValueError(f"Unsupported sample type: {region.dtype}")
+
+    if region.ndim == 2 or region.shape[2] == 1:
+        return cv2.cvtColor(region, cv2.COLOR_GRAY2BGR)
+    if region.shape[2] == 4:
+        return cv2.cvtColor(region, cv2.COLOR_RGBA2BGR)
+    return cv2.cvtColor(region, cv2.COLOR_RGB2BGR)
+
+class ImageSource:
+    """Random access to the pixels of an image without decoding all of it.
+
+    Regions come back as BGR uint8 arrays, like cv2.imread, so the rest of the
+    pipeline does not care how the file is stored.
+    """
+
+    width: int
+    height: int
+
+    # Side of the blocks read while building an overview
+    overview_block = 2048
+
+    def read_region(self, x: int, y: int, width: int, height: int) -> np.ndarray:
+        raise NotImplementedError
+
+    def overview(self, max_side: int) -> np.ndarray:
+        """The whole image downscaled so its longer side is at most max_side"""
+        scale = min(1.0, max_side / max(self.width, self.height))
+        out_width = max(1, round(self.width * scale))
+        out_height = max(1, round(self.height * scale))
+        overview = np.empty((out_height, out_width, 3), dtype=np.uint8)
+
+        # Block by block, so only one block is decoded at a time
+        block = self.overview_block
+        for y in range(0, self.height, block):
+            out_y0, out_y1 = round(y * scale), round(min(y + block, self.height) * scale)
+            for x in range(0, self.width, block):
+                out_x0, out_x1 = round(x * scale), round(min(x + block, self.width) * scale)
+                if out_y1 <= out_y0 or out_x1 <= out_x0:
+                    continue
+                region = self.read_region(x, y, min(block, self.width - x), min(block, self.height - y))
+                overview[out_y0:out_y1, out_x0:out_x1] = cv2.resize(
+                    region, (out_x1 - out_x0, out_y1 - out_y0), interpolation=cv2.INTER_AREA
+                )
+
+        return overview
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class DecodedImageSource(ImageSource):
+    """Formats without region access (PNG, JPEG, ...); decoded in full on first read"""
+
+    def __init__(self, image_path: str):
+        self.image_path = image_path
+        self._image = None
+
+        # Dimensions come from the header, so sizing an image costs no decode.
+        # cv2.imread applies the EXIF orientation, so report the rotated size
+        with Image.open(image_path) as image:
+            self.width, self.height = image.size
+            if image.getexif().get(EXIF_ORIENTATION) in TRANSPOSED_ORIENTATIONS:
+                self.width, self.height = self.height, self.width
+
+    def _decoded(self) -> np.ndarray:
+        if self._image is None:
+            self._image = cv2.imread(self.image_path)
+            if self._image is None:
+                raise ValueError(f"Could not load image from {self.image_path}")
+            # The decoded pixels are authoritative if the header disagreed
+            self.height, self.width = self._image.shape[:2]
+        return self._image
+
+    def read_region(self, x: int, y: int, width: int, height: int) -> np.ndarray:
+        return self._decoded()[y:y + height, x:x + width]
+
+    def overview(self, max_side: int) -> np.ndarray:
+        image = self._decoded()
+        scale = max_side / max(self.width, self.height)
+        if scale >= 1.0:
+            return image
+        return cv2.resize(image, (max(1, round(self.width * scale)), max(1, round(self.height * scale))),
+                          interpolation=cv2.INTER_AREA)
+
+    def close(self):
+        self._image = None
+
+class TiffImageSource(ImageSource):
+    """Tiled, striped or pyramidal TIFF read region by region.
+
+    Uncompressed files are memory-mapped and the OS pages in what a region
+    touches. Compressed files decode only the tiles or strips that intersect
+    the region. Overviews come from the smallest pyramid level large enough.
+    """
+
+    def __init__(self, image_path: str):
+        # Optional dependency; only needed for TIFF slide scans
+        import tifffile
+
+        self.image_path = image_path
+        self._tif = tifffile.TiffFile(image_path)
+        self._lock = threading.Lock()
+
+        try:
+            series = self._tif.series[0]
+            self._levels = list(getattr(series, "levels", [series]))
+            self._page = self._levels[0].keyframe
+
+            if self._page.planarconfig != 1 or len(self._page.shape) not in (2, 3):
+                raise ValueError(f"Unsupported TIFF layout: shape {self._page.shape}, planar config {self._page.planarconfig}")
+
+            self.height, self.width = self._page.shape[:2]
+            self._memmap = tifffile.memmap(image_path, mode="r") if self._page.is_memmappable else None
+        except Exception:
+            self._tif.close()
+            raise
+
+        if self._page.is_tiled:
+            self._segment_size = (self._page.tilelength, self._page.tilewidth)
+        else:
+            self._segment_size = (min(self._page.rowsperstrip, self.height), self.width)
+        self._segments_across = math.ceil(self.width / self._segment_size[1])
+
+        logger.info(
+            f"Opened {self.width}x{self.height} TIFF with {len(self._levels)} level(s) "
+            f"({'memory-mapped' if self._memmap is not None else f'{self._segment_size[1]}x{self._segment_size[0]} segments'})"
+        )
+
+    def read_region(self, x: int, y: int, width: int, height: int) -> np.ndarray:
+        width = min(width, self.width - x)
+        height = min(height, self.height - y)
+
+        if self._memmap is not None:
+            return _to_bgr(np.ascontiguousarray(self._memmap[y:y + height, x:x + width]))
+
+        with self._lock:
+            return _to_bgr(self._read_segments(x, y, width, height))
+
+    def _read_segments(self, x: int, y: int, width: int, height: int) -> np.ndarray:
+        """Decode the tiles/strips overlapping a region and copy out their intersection"""
+        page = self._page
+        segment_height, segment_width = self._segment_size
+        region = np.zeros((height, width, *page.shape[2:]), dtype=page.dtype)
+        filehandle = self._tif.filehandle
+
+        for row in range(y // segment_height, (y + height - 1) // segment_height + 1):
+            for column in range(x // segment_width, (x + width - 1) // segment_width + 1):
+                index = row * self._segments_across + column
+                if not page.databytecounts[index]:
+                    continue
+
+                filehandle.seek(page.dataoffsets[index])
+                data = filehandle.read(page.databytecounts[index])
+                segment, _, _ = page.decode(data, index, jpegtables=page.jpegtables)
+                segment = segment.reshape(segment.shape[-3:-1] + region.shape[2:])
+
+                # Intersection in image coordinates
+                top, left = row * segment_height, column * segment_width
+                y0, y1 = max(y, top), min(y + height, top + segment.shape[0])
+                x0, x1 = max(x, left), min(x + width, left + segment.shape[1])
+                region[y0 - y:y1 - y, x0 - x:x1 - x] = segment[y0 - top:y1 - top, x0 - left:x1 - left]
+
+        return region
+
+    def overview(self, max_side: int) -> np.ndarray:
+        # The smallest pyramid level that still covers max_side, scaled down the rest of the way
+        for level in reversed(self._levels[1:]):
+            if max(level.shape[:2]) >= max_side:
+                with self._lock:
+                    image = _to_bgr(level.asarray())
+                scale = max_side / max(image.shape[:2])
+                if scale < 1.0:
+                    image = cv2.resize(image, (max(1, round(image.shape[1] * scale)), max(1, round(image.shape[0] * scale))),
+                                       interpolation=cv2.INTER_AREA)
+                return image
+
+        return super().overview(max_side)
+
+    def close(self):
+        self._memmap = None
+        self._tif.close()
+
+def open_image_source(image_path: str) -> ImageSource:
+    """Region-readable source for TIFFs where possible, a decode-on-demand source otherwise"""
+    if Path(image_path).suffix.lower() in TIFF_SUFFIXES:
+        try:
+            return TiffImageSource(image_path)
+        except ImportError:
+            logger.warning("tifffile is not installed; decoding TIFF in full")
+        except Exception as e:
+            logger.warning(f"Could not open {image_path} for region reads, decoding in full: {str(e)}")
+
+    return DecodedImageSource(image_path)
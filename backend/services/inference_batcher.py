@@ -0,0 +1,87 @@
+import asyncio
+import numpy as np
+from typing import Callable, List, Optional, Tuple
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+class InferenceBatcher:
+    """Shared micro-batching queue in front of the cell classifier"""
+
+    def __init__(self, predict_fn: Callable[[np.ndarray], np.ndarray],
+                 max_batch_size: int = 64, max_wait_ms: float = 10.0):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+
+    def start(self):
+        """Start the background batching loop on the running event loop"""
+        if self._worker is None:
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+            logger.info(f"Inference batcher started (max batch: {self.max_batch_size}, max wait: {self.max_wait * 1000:.0f} ms)")
+
+    async def stop(self):
+        """Stop the batching loop"""
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+
+    async def predict(self, patches: np.ndarray) -> np.ndarray:
+        """Queue patches for classification and wait for this caller's predictions"""
+        if len(patches) == 0:
+            return self.predict_fn(patches)
+
+        if self._worker is None:
+            # Batcher not running; classify directly off the event loop
+            return await asyncio.to_thread(self.predict_fn, patches)
+
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((patches, future))
+        return await future
+
+    async def _run(self):
+        """Collect pending requests into batches capped by size or wait time"""
+        while True:
+            pending = [await self._queue.get()]
+            total = len(pending[0][0])
+            deadline = time.monotonic() + self.max_wait
+
+            while total < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout=remaining)
+                except asyncio.TimeoutError:
+                    break
+                pending.append(item)
+                total += len(item[0])
+
+            await self._dispatch(pending)
+
+    async def _dispatch(self, pending: List[Tuple[np.ndarray, asyncio.Future]]):
+        """Run one merged batch and hand each caller back its own slice"""
+        try:
+            merged = np.concatenate([patches for patches, _ in pending])
+            predictions = await asyncio.to_thread(self.predict_fn, merged)
+        except Exception as e:
+            logger.error(f"Error in batched inference: {str(e)}")
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        offset = 0
+        for patches, future in pending:
+            count = len(patches)
+            if not future.done():
+                future.set_result(predictions[offset:offset + count])
+            offset += count
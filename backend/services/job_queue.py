@@ -0,0 +1,229 @@
+import sqlite3
+import time
+from typing import Callable, Dict, Optional
+import logging
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+class JobQueue:
+    """Durable SQLite-backed queue of analysis jobs shared by the API and worker processes"""
+
+    def __init__(self, db_path: str = "bloodcell_analysis.db", lease_seconds: float = 60.0,
+                 max_attempts: int = 3):
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.connection = None
+
+    async def init_queue(self):
+        """Open the queue database and create the jobs table"""
+        try:
+            Path(self.db_path).parent.mkdir(parents=True, exist_ok=True)
+
+            # Autocommit mode; claims use explicit IMMEDIATE transactions
+            self.connection = sqlite3.connect(
+                self.db_path, timeout=30, isolation_level=None, check_same_thread=False
+            )
+            self.connection.row_factory = sqlite3.Row
+            self.connection.execute("PRAGMA journal_mode=WAL")
+
+            self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS analysis_jobs (
+                analysis_id TEXT PRIMARY KEY,
+                image_path TEXT NOT NULL,
+                image_hash TEXT,
+                state TEXT NOT NULL,
+                status TEXT NOT NULL,
+                progress INTEGER NOT NULL DEFAULT 0,
+                stage TEXT NOT NULL DEFAULT '',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                lease_owner TEXT,
+                lease_expires_at REAL,
+                last_error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                finished_at REAL
+            )
+            """)
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS idx_analysis_jobs_state ON analysis_jobs (state, created_at)"
+            )
+
+            logger.info(f"Job queue initialized: {self.db_path}")
+
+        except Exception as e:
+            logger.error(f"Error initializing job queue: {str(e)}")
+            raise
+
+    async def enqueue(self, analysis_id: str, image_path: str, image_hash: Optional[str] = None) -> None:
+        """Add a new analysis job in the queued state"""
+        now = time.time()
+        self.connection.execute("""
+            INSERT INTO analysis_jobs
+            (analysis_id, image_path, image_hash, state, status, progress, stage, created_at, updated_at)
+            VALUES (?, ?, ?, 'queued', 'uploaded', 10, 'Image uploaded successfully', ?, ?)
+        """, (analysis_id, image_path, image_hash, now, now))
+
+    async def claim(self, worker_id: str,
+                    on_expired: Optional[Callable[[str], None]] = None) -> Optional[Dict]:
+        """Lease the oldest queued job, or one whose previous lease expired.
+        
+        Jobs failed here because their last lease expired on the final attempt are
+        passed to `on_expired` once the transaction commits, so their terminal
+        state can be published.
+        """
+        now = time.time()
+        cursor = self.connection.cursor()
+        expired = []
+
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+
+            while True:
+                cursor.execute("""
+                    SELECT analysis_id, image_path, image_hash, attempts FROM analysis_jobs
+                    WHERE state = 'queued' OR (state = 'running' AND lease_expires_at < ?)
+                    ORDER BY created_at LIMIT 1
+                """, (now,))
+                row = cursor.fetchone()
+                if row is None:
+                    cursor.execute("COMMIT")
+                    self._notify_expired(expired, on_expired)
+                    return None
+
+                # A job whose worker died on its final attempt is not retried again
+                if row['attempts'] >= self.max_attempts:
+                    self._mark_failed(cursor, row['analysis_id'], "Worker lease expired", now)
+                    expired.append(row['analysis_id'])
+                    continue
+
+                cursor.execute("""
+                    UPDATE analysis_jobs
+                    SET state = 'running', attempts = attempts + 1, lease_owner = ?,
+                        lease_expires_at = ?, updated_at = ?
+                    WHERE analysis_id = ?
+                """, (worker_id, now + self.lease_seconds, now, row['analysis_id']))
+                cursor.execute("COMMIT")
+                self._notify_expired(expired, on_expired)
+
+                return {
+                    'analysis_id': row['analysis_id'],
+                    'image_path': row['image_path'],
+                    'image_hash': row['image_hash'],
+                    'attempt': row['attempts'] + 1
+                }
+
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
+
+    @staticmethod
+    def _notify_expired(expired, on_expired: Optional[Callable[[str], None]]):
+        if on_expired is not None:
+            for analysis_id in expired:
+                on_expired(analysis_id)
+
+    async def heartbeat(self, analysis_id: str, worker_id: str) -> bool:
+        """Extend the lease on a running job; False if the lease was lost"""
+        now = time.time()
+        cursor = self.connection.execute("""
+            UPDATE analysis_jobs SET lease_expires_at = ?, updated_at = ?
+            WHERE analysis_id = ? AND state = 'running' AND lease_owner = ?
+        """, (now + self.lease_seconds, now, analysis_id, worker_id))
+        return cursor.rowcount == 1
+
+    async def update_progress(self, analysis_id: str, update: Dict) -> None:
+        """Record the current stage of a job"""
+        self.connection.execute("""
+            UPDATE analysis_jobs SET status = ?, progress = ?, stage = ?, updated_at = ?
+            WHERE analysis_id = ?
+        """, (update['status'], update['progress'], update['stage'], time.time(), analysis_id))
+
+    async def complete(self, analysis_id: str, worker_id: str) -> bool:
+        """Mark a job as finished successfully; False if `worker_id` no longer holds its lease"""
+        now = time.time()
+        cursor = self.connection.execute("""
+            UPDATE analysis_jobs
+            SET state = 'completed', lease_owner = NULL, lease_expires_at = NULL,
+                updated_at = ?, finished_at = ?
+            WHERE analysis_id = ? AND state = 'running' AND lease_owner = ?
+        """, (now, now, analysis_id, worker_id))
+        return cursor.rowcount == 1
+
+    async def fail(self, analysis_id: str, worker_id: str, error: str) -> bool:
+        """Requeue a failed job if it has attempts left, else mark it failed.
+
+        Returns False, changing nothing, if `worker_id` no longer holds the lease:
+        the job may already be running again under another worker.
+        """
+        now = time.time()
+        cursor = self.connection.cursor()
+
+        cursor.execute("""
+            SELECT attempts FROM analysis_jobs
+            WHERE analysis_id = ? AND state = 'running' AND lease_owner = ?
+        """, (analysis_id, worker_id))
+        row = cursor.fetchone()
+        if row is None:
+            return False
+
+        if row['attempts'] < self.max_attempts:
+            cursor.execute("""
+                UPDATE analysis_jobs
+                SET state = 'queued', status = 'queued', progress = 10, stage = ?,
+                    lease_owner = NULL, lease_expires_at = NULL, last_error = ?, updated_at = ?
+                WHERE analysis_id = ? AND state = 'running' AND lease_owner = ?
+            """, (f"Retrying analysis (attempt {row['attempts'] + 1} of {self.max_attempts})...",
+                  error, now, analysis_id, worker_id))
+            if cursor.rowcount == 1:
+                logger.warning(f"Analysis {analysis_id} failed, requeued: {error}")
+            return cursor.rowcount == 1
+
+        return self._mark_failed(cursor, analysis_id, error, now, lease_owner=worker_id)
+
+    def _mark_failed(self, cursor, analysis_id: str, error: str, now: float,
+                     lease_owner: Optional[str] = None) -> bool:
+        """Fail a job for good, only while `lease_owner` holds it when one is given"""
+        cursor.execute("""
+            UPDATE analysis_jobs
+            SET state = 'failed', status = 'error', progress = 0, stage = ?,
+                lease_owner = NULL, lease_expires_at = NULL, last_error = ?,
+                updated_at = ?, finished_at = ?
+            WHERE analysis_id = ? AND (? IS NULL OR (state = 'running' AND lease_owner = ?))
+        """, (f"Analysis failed: {error}", error, now, now, analysis_id, lease_owner, lease_owner))
+        if cursor.rowcount == 1:
+            logger.error(f"Analysis {analysis_id} failed permanently: {error}")
+        return cursor.rowcount == 1
+
+    async def get_progress(self, analysis_id: str) -> Optional[Dict]:
+        """Get the current progress of a job"""
+        cursor = self.connection.execute(
+            "SELECT status, progress, stage FROM analysis_jobs WHERE analysis_id = ?", (analysis_id,)
+        )
+        row = cursor.fetchone()
+
+        if row:
+            return {
+                'status': row['status'],
+                'progress': row['progress'],
+                'stage': row['stage']
+            }
+
+        return None
+
+    async def cleanup(self, ttl_seconds: float) -> int:
+        """Delete finished jobs older than the TTL"""
+        cursor = self.connection.execute("""
+            DELETE FROM analysis_jobs
+            WHERE state IN ('completed', 'failed') AND finished_at < ?
+        """, (time.time() - ttl_seconds,))
+
+        if cursor.rowcount:
+            logger.info(f"Removed {cursor.rowcount} finished jobs from the queue")
+        return cursor.rowcount
+
+    def close(self):
+        """Close queue connection"""
+        if self.connection:
+            self.connection.close()
@@ -0,0 +1,34 @@
+import asyncio
+import logging
+from typing import Dict, Set
+
+logger = logging.getLogger(__name__)
+
+TERMINAL_STATUSES = {"completed", "error"}
+
+class ProgressHub:
+    """Fan-out of analysis progress updates to streaming subscribers"""
+
+    def __init__(self):
+        self._subscribers: Dict[str, Set[asyncio.Queue]] = {}
+
+    def subscribe(self, analysis_id: str) -> asyncio.Queue:
+        """Register a subscriber queue for one analysis"""
+        queue = asyncio.Queue()
+        self._subscribers.setdefault(analysis_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, analysis_id: str, queue: asyncio.Queue):
+        """Remove a subscriber; the analysis entry is dropped with its last subscriber"""
+        subscribers = self._subscribers.get(analysis_id)
+        if subscribers is None:
+            return
+
+        subscribers.discard(queue)
+        if not subscribers:
+            del self._subscribers[analysis_id]
+
+    def publish(self, analysis_id: str, update: Dict):
+        """Deliver an update to every subscriber of the analysis"""
+        for queue in self._subscribers.get(analysis_id, ()):
+            queue.put_nowait(update)
@@ -0,0 +1,116 @@
+import cv2
+import numpy as np
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Tuple
+import logging
+import time
+
+from services.image_source import DecodedImageSource, open_image_source
+
+logger = logging.getLogger(__name__)
+
+# cv2.imread flags that decode at 1/2, 1/4 or 1/8 scale (DCT scaling for JPEG)
+REDUCED_GRAYSCALE_FLAGS = {
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2
+}
+
+@dataclass
+class QualityReport:
+    """Outcome of the upload quality gate, measured on a reduced-resolution preview"""
+    width: int
+    height: int
+    preview_width: int = 0
+    preview_height: int = 0
+    decode_scale: int = 1
+    brightness: float = 0.0
+    blur_score: float = 0.0
+    issues: List[str] = field(default_factory=list)
+    elapsed_ms: float = 0.0
+
+    @property
+    def passed(self) -> bool:
+        return not self.issues
+
+    def to_dict(self) -> Dict:
+        return {**asdict(self), "passed": self.passed}
+
+class QualityGate:
+    """Cheap accept/reject check run on upload, before an image takes a worker slot.
+
+    Brightness and sharpness are judged on a grayscale preview whose longer side
+    is `preview_side`, decoded at reduced scale where the format allows it. The
+    blur score is the Laplacian variance of that preview, so it is comparable
+    across capture resolutions.
+    """
+
+    def __init__(self, min_size: Tuple[int, int] = (256, 256), min_brightness: float = 30,
+                 max_brightness: float = 220, min_blur_score: float = 10.0, preview_side: int = 512):
+        self.min_size = min_size
+        self.min_brightness = min_brightness
+        self.max_brightness = max_brightness
+        self.min_blur_score = min_blur_score
+        self.preview_side = preview_side
+
+    def check(self, image_path: str) -> QualityReport:
+        """Measure an image and list the reasons, if any, to reject it"""
+        start = time.perf_counter()
+
+        try:
+            with open_image_source(image_path) as source:
+                report = QualityReport(width=source.width, height=source.height)
+                preview = self._preview(source, report)
+        except Exception as e:
+            logger.warning(f"Quality gate could not read {image_path}: {str(e)}")
+            report = QualityReport(width=0, height=0, issues=["Image could not be decoded"])
+            report.elapsed_ms = (time.perf_counter() - start) * 1000
+            return report
+
+        if report.width < self.min_size[1] or report.height < self.min_size[0]:
+            report.issues.append(
+                f"Image resolution too low: {report.width}x{report.height}. "
+                f"Minimum required: {self.min_size[0]}x{self.min_size[1]}"
+            )
+
+        report.preview_height, report.preview_width = preview.shape
+        report.brightness = float(np.mean(preview))
+        report.blur_score = float(cv2.Laplacian(preview, cv2.CV_64F).var())
+
+        if report.brightness < self.min_brightness:
+            report.issues.append("Image is too dark for analysis")
+        elif report.brightness > self.max_brightness:
+            report.issues.append("Image is too bright/overexposed for analysis")
+
+        if report.blur_score < self.min_blur_score:
+            report.issues.append(f"Image is too blurred for analysis (blur score: {report.blur_score:.1f})")
+
+        report.elapsed_ms = (time.perf_counter() - start) * 1000
+        logger.info(
+            f"Quality gate {'passed' if report.passed else 'rejected'} {image_path} in {report.elapsed_ms:.0f} ms "
+            f"(1/{report.decode_scale} decode, brightness {report.brightness:.1f}, blur score {report.blur_score:.1f})"
+        )
+        return report
+
+    def _preview(self, source, report: QualityReport) -> np.ndarray:
+        """Grayscale preview no longer than preview_side, decoded as small as possible"""
+        longer_side = max(source.width, source.height)
+
+        if isinstance(source, DecodedImageSource):
+            # Largest reduction that still leaves at least preview_side pixels
+            scale = next((scale for scale in REDUCED_GRAYSCALE_FLAGS if longer_side // scale >= self.preview_side), 1)
+            flag = REDUCED_GRAYSCALE_FLAGS.get(scale, cv2.IMREAD_GRAYSCALE)
+            preview = cv2.imread(source.image_path, flag)
+            if preview is None:
+                raise ValueError(f"Could not load image from {source.image_path}")
+            report.decode_scale = scale
+        else:
+            # Region-readable sources downscale from a pyramid level or block by block
+            preview = cv2.cvtColor(source.overview(self.preview_side), cv2.COLOR_BGR2GRAY)
+            report.decode_scale = max(1, round(longer_side / max(preview.shape)))
+
+        factor = self.preview_side / max(preview.shape)
+        if factor < 1.0:
+            preview = cv2.resize(preview, (max(1, round(preview.shape[1] * factor)), max(1, round(preview.shape[0] * factor))),
+                                 interpolation=cv2.INTER_AREA)
+        return preview
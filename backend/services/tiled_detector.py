@@ -0,0 +1,88 @@
+import asyncio
+import numpy as np
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import List, Tuple
+import logging
+import time
+
+from services.image_processor import ImageTile
+
+logger = logging.getLogger(__name__)
+
+class TiledCellDetector:
+    """Full-resolution cell detection over overlapping tiles of a large image.
+
+    Tiles are preprocessed and searched for cells in parallel worker threads, with
+    a bounded number in flight. Tiles are read from the file only as they are
+    needed, so memory depends on the tile size rather than on the image. A cell
+    inside an overlap is found by both tiles; only the tile that owns its centre
+    keeps it.
+
+    Each tile is searched at detection-field resolution and the boxes are mapped
+    back to full resolution. The image's area is reported as the share of the
+    analysis canvas it covers, as the resized path reports it, so counts are
+    normalized the same way on both paths.
+    """
+
+    def __init__(self, image_processor, efficientnet_model, max_workers: int = 2):
+        self.image_processor = image_processor
+        self.efficientnet_model = efficientnet_model
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tile")
+
+    async def detect(self, image_path: str) -> Tuple[List[np.ndarray], float]:
+        """Detect cells in the full-resolution image; one region per cell, and the area in fields"""
+        return await asyncio.to_thread(self._detect_sync, image_path)
+
+    def shutdown(self):
+        """Release tile worker threads"""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _detect_sync(self, image_path: str) -> Tuple[List[np.ndarray], float]:
+        start = time.perf_counter()
+
+        cell_regions = []
+        pending = set()
+        tile_count = 0
+
+        with self.image_processor.open_image(image_path) as source:
+            width, height = source.width, source.height
+            scale = self.image_processor.canvas_scale(width, height)
+
+            for tile in self.image_processor.iter_tiles(source):
+                # Keep at most two tiles per worker in flight
+                if len(pending) >= self.max_workers * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        cell_regions.extend(future.result())
+
+                pending.add(self._executor.submit(self._process_tile, tile, scale))
+                tile_count += 1
+
+            for future in wait(pending).done:
+                cell_regions.extend(future.result())
+
+        fields = self.image_processor.canvas_fields(width, height)
+
+        logger.info(
+            f"Detected {len(cell_regions)} cell regions in {tile_count} tiles of a {width}x{height} image "
+            f"at {scale:.2f}x detection scale ({time.perf_counter() - start:.1f}s)"
+        )
+        return cell_regions, fields
+
+    def _process_tile(self, tile: ImageTile, scale: float = 1.0) -> List[np.ndarray]:
+        """Preprocess one tile and return the cells whose centre lies in its core"""
+        processed = self.image_processor.preprocess_tile(tile.image)
+
+        # Copies, so the tile itself can be released
+        return [processed[y1:y2, x1:x2].copy() for x1, y1, x2, y2 in self._owned_boxes(tile, processed, scale)]
+
+    def _owned_boxes(self, tile: ImageTile, processed: np.ndarray, scale: float = 1.0) -> np.ndarray:
+        """Boxes, in tile coordinates, of the cells in a preprocessed tile whose centre lies in its core"""
+        boxes = self.efficientnet_model.detect_cell_boxes(processed, scale)
+
+        core_x0, core_y0, core_x1, core_y1 = tile.core
+        centre_x = tile.x + (boxes[:, 0] + boxes[:, 2]) // 2
+        centre_y = tile.y + (boxes[:, 1] + boxes[:, 3]) // 2
+        owned = (centre_x >= core_x0) & (centre_x < core_x1) & (centre_y >= core_y0) & (centre_y < core_y1)
+        return boxes[owned]
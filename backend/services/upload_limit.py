@@ -0,0 +1,57 @@
+import json
+from typing import Iterable
+
+from fastapi import HTTPException
+
+class RequestSizeLimit:
+    """ASGI middleware capping request bodies on some paths before anything parses them.
+
+    Starlette spools a multipart body to a temporary file before the endpoint
+    runs, so a limit checked while copying the upload only bounds the second
+    copy. A declared Content-Length over the limit is answered with 413
+    without reading the body; otherwise the body is counted as it arrives and
+    reading fails once it passes the limit.
+    """
+
+    def __init__(self, app, max_bytes: int, paths: Iterable[str]):
+        self.app = app
+        self.max_bytes = max_bytes
+        self.paths = set(paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+
+        declared = dict(scope["headers"]).get(b"content-length")
+        if declared is not None and declared.isdigit() and int(declared) > self.max_bytes:
+            await self._reject(send)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    # Raised inside body parsing, so the app's exception handling answers it
+                    raise HTTPException(status_code=413, detail=self.detail)
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+    @property
+    def detail(self) -> str:
+        return f"Request body too large (max {self.max_bytes / 2 ** 20:.0f}MB)"
+
+    async def _reject(self, send):
+        body = json.dumps({"detail": self.detail}).encode()
+        await send({
+            "type": "http.response.start",
+            "status": 413,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode()),
+                        (b"connection", b"close")]
+        })
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,293 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+class AnalysisWorkerPool:
+    """Local worker processes that load the CV models once and run queued analysis jobs.
+
+    A monitor thread respawns workers whose process died, waiting `respawn_backoff`
+    seconds after a first crash and twice as long after each further one, up to
+    `max_respawn_backoff`; the wait resets once the new process reports ready.
+    """
+
+    def __init__(self, num_workers: int = 2, jobs_per_worker: int = 4,
+                 worker_config: Optional[Dict] = None, respawn_backoff: float = 1.0,
+                 max_respawn_backoff: float = 60.0, monitor_interval: float = 1.0):
+        self.num_workers = num_workers
+        self.jobs_per_worker = jobs_per_worker
+        self.worker_config = worker_config or {}
+        self.respawn_backoff = respawn_backoff
+        self.max_respawn_backoff = max_respawn_backoff
+        self.monitor_interval = monitor_interval
+        self._ready = set()
+        self._crashes: Dict[int, int] = {}  # consecutive crashes per worker, cleared when it is ready
+        self._worker_main = _worker_main
+
+        # Spawn so workers never inherit the API process's threads or event loop
+        self._context = multiprocessing.get_context("spawn")
+        self._events = self._context.Queue()
+        self._stop = self._context.Event()
+        self._processes: Dict[int, multiprocessing.process.BaseProcess] = {}
+        self._listener: Optional[threading.Thread] = None
+        self._monitor: Optional[threading.Thread] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._on_progress: Optional[Callable[[str, Dict], None]] = None
+
+    def start(self, on_progress: Optional[Callable[[str, Dict], None]] = None):
+        """Spawn worker processes and start relaying their events to `on_progress`"""
+        self._loop = asyncio.get_running_loop()
+        self._on_progress = on_progress
+
+        for worker_id in range(self.num_workers):
+            self._spawn(worker_id)
+
+        self._listener = threading.Thread(target=self._relay_events, name="analysis-events", daemon=True)
+        self._listener.start()
+        self._monitor = threading.Thread(target=self._monitor_workers, name="analysis-monitor", daemon=True)
+        self._monitor.start()
+
+        logger.info(f"Started {self.num_workers} analysis worker processes")
+
+    def stop(self, timeout: float = 10.0):
+        """Ask workers to finish their current jobs and exit"""
+        self._stop.set()
+        if self._monitor is not None:
+            self._monitor.join()
+
+        for process in self._processes.values():
+            process.join(timeout)
+            if process.is_alive():
+                # Unfinished jobs are picked up again once their lease expires
+                process.terminate()
+
+        self._events.put(None)
+        self._processes = {}
+        self._ready.clear()
+        logger.info("Analysis worker processes stopped")
+
+    @property
+    def ready_workers(self) -> set:
+        """Ids of workers that finished loading and whose process is still alive"""
+        return {
+            worker_id for worker_id in self._ready
+            if worker_id in self._processes and self._processes[worker_id].is_alive()
+        }
+
+    def _spawn(self, worker_id: int):
+        process = self._context.Process(
+            target=self._worker_main,
+            args=(worker_id, self._events, self._stop, self.jobs_per_worker, self.worker_config),
+            name=f"analysis-worker-{worker_id}",
+            daemon=True
+        )
+        process.start()
+        self._processes[worker_id] = process
+
+    def _monitor_workers(self):
+        """Respawn worker processes that died, backing off after repeated crashes"""
+        respawn_at: Dict[int, float] = {}
+
+        while not self._stop.wait(self.monitor_interval):
+            for worker_id, process in list(self._processes.items()):
+                if process.is_alive():
+                    continue
+
+                if worker_id not in respawn_at:
+                    crashes = self._crashes.get(worker_id, 0)
+                    delay = min(self.max_respawn_backoff, self.respawn_backoff * 2 ** crashes)
+                    self._crashes[worker_id] = crashes + 1
+                    respawn_at[worker_id] = time.monotonic() + delay
+                    logger.warning(
+                        f"Analysis worker {worker_id} exited with code {process.exitcode}; respawning in {delay:.1f}s"
+                    )
+                elif time.monotonic() >= respawn_at[worker_id] and not self._stop.is_set():
+                    del respawn_at[worker_id]
+                    # Not ready until the new process has loaded its models; scheduled
+                    # before it starts, so it runs ahead of the new process's ready event
+                    self._loop.call_soon_threadsafe(self._ready.discard, worker_id)
+                    self._spawn(worker_id)
+
+    def _relay_events(self):
+        """Forward worker events onto the API event loop"""
+        while True:
+            event = self._events.get()
+            if event is None:
+                break
+            self._loop.call_soon_threadsafe(self._handle_event, event)
+
+    def _handle_event(self, event: Tuple):
+        kind, key, payload = event
+
+        if kind == "ready":
+            self._ready.add(key)
+            self._crashes.pop(key, None)
+            logger.info(f"Analysis worker {key} ready")
+        elif kind == "progress" and self._on_progress:
+            self._on_progress(key, payload)
+
+async def _load_calibration_images(image_processor, upload_dir: str, limit: int) -> List:
+    """Preprocess up to `limit` stored uploads to calibrate a quantized classifier"""
+    images = []
+
+    for path in sorted(Path(upload_dir).glob("*"))[:limit * 2]:
+        try:
+            images.append(await image_processor.preprocess_image(str(path)))
+        except Exception as e:
+            logger.warning(f"Skipping calibration image {path.name}: {str(e)}")
+        if len(images) >= limit:
+            break
+
+    return images
+
+def _worker_main(worker_id: int, events, stop, jobs_per_worker: int, config: Dict):
+    """Entry point of a worker process"""
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_worker_loop(worker_id, events, stop, jobs_per_worker, config))
+
+async def _worker_loop(worker_id: int, events, stop, jobs_per_worker: int, config: Dict):
+    """Load models once, then lease and run up to `jobs_per_worker` jobs concurrently"""
+
+    # Imported here so the API process never loads TensorFlow
+    from services.image_processor import ImageProcessor
+    from services.analysis_service import AnalysisService
+    from services.analysis_pipeline import AnalysisPipeline
+    from services.inference_batcher import InferenceBatcher
+    from services.tiled_detector import TiledCellDetector
+    from services.stage_cache import StageCache
+    from services.job_queue import JobQueue
+    from models.efficientnet_model import EfficientNetB0Model
+    from database import Database
+
+    worker_name = f"worker-{worker_id}-{os.getpid()}"
+
+    efficientnet_model = EfficientNetB0Model(
+        batch_size=config.get("batch_size", 32),
+        artifact_dir=config.get("artifact_dir", "model_cache")
+    )
+    await efficientnet_model.load_model()
+
+    batcher = InferenceBatcher(
+        efficientnet_model.predict_patches,
+        max_batch_size=config.get("max_batch", 64),
+        max_wait_ms=config.get("max_wait_ms", 10.0)
+    )
+    batcher.start()
+    efficientnet_model.batcher = batcher
+
+    stage_cache_mb = config.get("stage_cache_mb", 1024)
+    stage_cache = StageCache(
+        config.get("stage_cache_dir", "stage_cache"), max_bytes=stage_cache_mb * 2 ** 20
+    ) if stage_cache_mb > 0 else None
+
+    image_processor = ImageProcessor(
+        max_workers=config.get("preprocess_workers", 2),
+        tile_size=config.get("tile_size", 1024),
+        tile_overlap=config.get("tile_overlap", 128),
+        tiled_min_side=config.get("tiled_min_side", 0),
+        preprocess_mode=config.get("preprocess_mode", "classic"),
+        denoise_mode=config.get("denoise_mode", "auto"),
+        stage_cache=stage_cache
+    )
+    tiled_detector = TiledCellDetector(
+        image_processor, efficientnet_model, max_workers=config.get("tile_workers", 2)
+    )
+
+    backend = config.get("classifier_backend", "tensorflow")
+    if backend != efficientnet_model.backend:
+        await efficientnet_model.select_backend(
+            backend,
+            calibration_images=lambda: _load_calibration_images(
+                image_processor, config.get("upload_dir", "uploads"), config.get("calibration_images", 20)
+            ),
+            intra_op_threads=config.get("intra_op_threads", 0),
+            inter_op_threads=config.get("inter_op_threads", 0),
+            min_int8_agreement=config.get("int8_min_agreement", 0.95)
+        )
+
+    db = Database(config.get("db_path", "bloodcell_analysis.db"))
+    await db.init_db()
+
+    job_queue = JobQueue(
+        config.get("db_path", "bloodcell_analysis.db"),
+        lease_seconds=config.get("lease_seconds", 60.0),
+        max_attempts=config.get("max_attempts", 3)
+    )
+    await job_queue.init_queue()
+
+    pipeline = AnalysisPipeline(
+        image_processor, efficientnet_model, AnalysisService(), db, tiled_detector=tiled_detector
+    )
+    events.put(("ready", worker_id, None))
+
+    poll_interval = config.get("poll_interval", 0.5)
+    slots = asyncio.Semaphore(jobs_per_worker)
+    running = set()
+
+    async def keep_lease(analysis_id: str):
+        while True:
+            await asyncio.sleep(job_queue.lease_seconds / 3)
+            if not await job_queue.heartbeat(analysis_id, worker_name):
+                logger.warning(f"Lost lease on analysis {analysis_id}")
+                return
+
+    async def report(analysis_id: str, update: Dict):
+        await job_queue.update_progress(analysis_id, update)
+        events.put(("progress", analysis_id, update))
+
+    async def run_job(job: Dict):
+        analysis_id = job['analysis_id']
+        heartbeat = asyncio.create_task(keep_lease(analysis_id))
+
+        try:
+            await pipeline.perform_analysis(
+                analysis_id, job['image_path'],
+                lambda update: report(analysis_id, update),
+                image_hash=job['image_hash']
+            )
+            if not await job_queue.complete(analysis_id, worker_name):
+                logger.warning(f"Analysis {analysis_id} finished after its lease passed to another worker")
+        except Exception as e:
+            if await job_queue.fail(analysis_id, worker_name, str(e)):
+                events.put(("progress", analysis_id, await job_queue.get_progress(analysis_id)))
+            else:
+                logger.warning(f"Analysis {analysis_id} failed after its lease passed to another worker: {str(e)}")
+        finally:
+            heartbeat.cancel()
+            slots.release()
+
+    while not stop.is_set():
+        await slots.acquire()
+
+        expired = []
+        try:
+            job = await job_queue.claim(worker_name, on_expired=expired.append)
+        except Exception as e:
+            logger.error(f"Error claiming job: {str(e)}")
+            job = None
+
+        # Jobs failed for an expired final lease: let their subscribers see the end state
+        for analysis_id in expired:
+            events.put(("progress", analysis_id, await job_queue.get_progress(analysis_id)))
+
+        if job is None:
+            slots.release()
+            await asyncio.sleep(poll_interval)
+            continue
+
+        task = asyncio.create_task(run_job(job))
+        running.add(task)
+        task.add_done_callback(running.discard)
+
+    await asyncio.gather(*running)
+    await batcher.stop()
+    tiled_detector.shutdown()
+    image_processor.shutdown()
+    job_queue.close()
+    db.close()
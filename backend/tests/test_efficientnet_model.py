@@ -0,0 +1,90 @@
+import json
+
+import numpy as np
+import pytest
+
+pytest.importorskip("tensorflow")
+
+from models import efficientnet_model
+from models.efficientnet_model import EfficientNetB0Model
+
+class StubInt8Backend:
+    name = "tflite_int8"
+
+    def __init__(self, model_path, batch_size):
+        self.model_path = model_path
+
+@pytest.fixture
+def model(tmp_path, monkeypatch):
+    monkeypatch.setattr(efficientnet_model, "TFLiteInt8Backend", StubInt8Backend)
+    model = EfficientNetB0Model(artifact_dir=str(tmp_path))
+    model.classifier = object()  # float backend in use
+
+    model.artifact_path.mkdir(parents=True)
+    (model.artifact_path / "classifier_int8.tflite").write_bytes(b"")
+    return model
+
+def write_report(model, agreement):
+    report_path = model.artifact_path / "classifier_int8_report.json"
+    report_path.write_text(json.dumps({"top1_agreement": agreement}))
+
+@pytest.mark.asyncio
+async def test_int8_below_minimum_agreement_keeps_float_backend(model):
+    write_report(model, 0.0)
+
+    assert not await model.select_backend("tflite_int8", min_int8_agreement=0.95)
+    assert model.backend == "tensorflow"
+    assert not isinstance(model.classifier, StubInt8Backend)
+
+@pytest.mark.asyncio
+async def test_int8_meeting_minimum_agreement_is_used(model):
+    write_report(model, 0.97)
+
+    assert await model.select_backend("tflite_int8", min_int8_agreement=0.95)
+    assert model.backend == "tflite_int8"
+    assert isinstance(model.classifier, StubInt8Backend)
+
+@pytest.mark.asyncio
+async def test_int8_without_report_keeps_float_backend(model):
+    assert not await model.select_backend("tflite_int8")
+    assert model.backend == "tensorflow"
+
+@pytest.mark.asyncio
+async def test_int8_without_enough_held_out_patches_is_not_verified(model, monkeypatch):
+    (model.artifact_path / "classifier_int8.tflite").unlink()
+    quantized = []
+    monkeypatch.setattr(StubInt8Backend, "quantize", staticmethod(lambda *args: quantized.append(args) or b""),
+                        raising=False)
+
+    async def extract_patches(image):
+        return list(np.zeros((20, 224, 224, 3), dtype=np.float32))
+    monkeypatch.setattr(model, "extract_patches", extract_patches)
+
+    async def calibration_images():
+        return [np.zeros((64, 64, 3), dtype=np.uint8)]
+
+    assert not await model.select_backend("tflite_int8", calibration_images, min_int8_agreement=0.0)
+    assert model.backend == "tensorflow"
+
+    report = json.loads((model.artifact_path / "classifier_int8_report.json").read_text())
+    assert report["verified"] is False
+    assert not quantized
+    assert not (model.artifact_path / "classifier_int8.tflite").exists()
+
+def test_patch_batch_equals_stacked_cell_patches(tmp_path):
+    model = EfficientNetB0Model(artifact_dir=str(tmp_path))
+    model.max_patches_per_step = 4
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 256, (300, 400, 3), dtype=np.uint8)
+
+    # Views into one image, as detection yields them, of varied sizes and aspect ratios
+    regions = [image[y:y + height, x:x + width]
+               for x, y, width, height in [(0, 0, 40, 40), (10, 20, 90, 35), (200, 100, 17, 63), (350, 250, 50, 50),
+                                           (120, 60, 224, 224), (5, 5, 300, 200)]]
+
+    for batch_regions in (regions[:3], regions, regions[2:4]):
+        expected = np.stack([model._preprocess_cell_patch(region) for region in batch_regions])
+        batch = model._patch_batch(batch_regions)
+
+        assert batch.dtype == np.float32
+        np.testing.assert_array_equal(batch, expected)
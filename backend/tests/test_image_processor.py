@@ -0,0 +1,37 @@
+import cv2
+import numpy as np
+import pytest
+
+from services.image_processor import ImageProcessor
+
+def smear(width, height, seed=0):
+    """Pale background with darker discs of cell size, lightly blurred and noisy"""
+    rng = np.random.default_rng(seed)
+    image = np.full((height, width, 3), (205, 190, 225), dtype=np.uint8)
+    for _ in range(width * height // 2500):
+        x, y = rng.integers(0, width), rng.integers(0, height)
+        radius = int(rng.integers(width // 140 + 3, width // 70 + 6))
+        cv2.circle(image, (int(x), int(y)), radius, tuple(int(c) for c in rng.integers(90, 170, 3)), -1)
+    image = cv2.GaussianBlur(image, (5, 5), 0)
+    return np.clip(image + rng.normal(0, 4, image.shape), 0, 255).astype(np.uint8)
+
+@pytest.fixture
+def processors():
+    processors = {mode: ImageProcessor(max_workers=1, preprocess_mode=mode, denoise_mode="none")
+                  for mode in ("classic", "fused")}
+    yield processors
+    for processor in processors.values():
+        processor.shutdown()
+
+@pytest.mark.parametrize("width, height", [(1024, 1024), (640, 480), (1500, 1100)])
+@pytest.mark.parametrize("resize", [True, False])
+def test_fused_output_equals_classic(processors, width, height, resize):
+    image = smear(width, height)
+    classic = processors["classic"].run_pipeline(image, resize=resize)
+
+    # Twice, so the second run goes through the reused buffers
+    for _ in range(2):
+        np.testing.assert_array_equal(processors["fused"].run_pipeline(image, resize=resize), classic)
+
+def test_preprocess_mode_is_part_of_the_configuration(processors):
+    assert processors["classic"].config() != processors["fused"].config()
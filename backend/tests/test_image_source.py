@@ -0,0 +1,29 @@
+import cv2
+import numpy as np
+from PIL import Image
+
+from services.image_processor import ImageProcessor
+from services.image_source import EXIF_ORIENTATION, open_image_source
+
+def rotated_jpeg(path, width=400, height=300, orientation=6):
+    """A landscape JPEG stored with an EXIF tag asking viewers to rotate it"""
+    pixels = np.random.default_rng(0).integers(60, 200, (height, width, 3), dtype=np.uint8)
+    exif = Image.Exif()
+    exif[EXIF_ORIENTATION] = orientation
+    Image.fromarray(pixels).save(path, exif=exif, quality=95)
+    return str(path)
+
+def test_decoded_source_reports_oriented_size(tmp_path):
+    path = rotated_jpeg(tmp_path / "rotated.jpg")
+    expected_height, expected_width = cv2.imread(path).shape[:2]
+    assert (expected_width, expected_height) == (300, 400)
+
+    with open_image_source(path) as source:
+        assert (source.width, source.height) == (expected_width, expected_height)
+        assert source.read_region(0, 0, source.width, source.height).shape[:2] == (expected_height, expected_width)
+
+def test_load_image_keeps_the_whole_rotated_image(tmp_path):
+    path = rotated_jpeg(tmp_path / "rotated.jpg")
+    image = ImageProcessor(max_workers=1).load_image(path)
+
+    np.testing.assert_array_equal(image, cv2.imread(path))
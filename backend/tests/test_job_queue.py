@@ -0,0 +1,74 @@
+import time
+
+import pytest
+import pytest_asyncio
+
+from services.job_queue import JobQueue
+
+@pytest_asyncio.fixture
+async def queue(tmp_path):
+    queue = JobQueue(str(tmp_path / "queue.db"), lease_seconds=60, max_attempts=1)
+    await queue.init_queue()
+    yield queue
+    queue.close()
+
+def expire_lease(queue: JobQueue, analysis_id: str):
+    queue.connection.execute(
+        "UPDATE analysis_jobs SET lease_expires_at = ? WHERE analysis_id = ?", (time.time() - 1, analysis_id)
+    )
+
+@pytest.mark.asyncio
+async def test_complete_requires_current_lease(queue):
+    await queue.enqueue("a", "a.png")
+    queue.max_attempts = 2
+    await queue.claim("worker-1")
+    expire_lease(queue, "a")
+    await queue.claim("worker-2")
+
+    assert not await queue.complete("a", "worker-1")
+    assert await queue.complete("a", "worker-2")
+
+@pytest.mark.asyncio
+async def test_expired_final_lease_is_reported(queue):
+    await queue.enqueue("a", "a.png")
+    await queue.claim("worker-1")
+    expire_lease(queue, "a")
+
+    expired = []
+    assert await queue.claim("worker-2", on_expired=expired.append) is None
+    assert expired == ["a"]
+    assert (await queue.get_progress("a"))["status"] == "error"
+
+@pytest.mark.asyncio
+async def test_stale_worker_cannot_fail_a_reclaimed_job(queue):
+    await queue.enqueue("a", "a.png")
+    queue.max_attempts = 3
+    await queue.claim("worker-1")
+    expire_lease(queue, "a")
+    await queue.claim("worker-2")
+
+    # Neither requeued (a duplicate run) nor failed (dropping worker-2's result)
+    assert not await queue.fail("a", "worker-1", "out of memory")
+    assert await queue.claim("worker-3") is None
+    assert await queue.complete("a", "worker-2")
+
+@pytest.mark.asyncio
+async def test_stale_worker_cannot_fail_a_reclaimed_final_attempt(queue):
+    await queue.enqueue("a", "a.png")
+    queue.max_attempts = 2
+    await queue.claim("worker-1")
+    expire_lease(queue, "a")
+    await queue.claim("worker-2")
+
+    assert not await queue.fail("a", "worker-1", "out of memory")
+    assert (await queue.get_progress("a"))["status"] != "error"
+    assert await queue.complete("a", "worker-2")
+
+@pytest.mark.asyncio
+async def test_lease_holder_failure_is_requeued(queue):
+    await queue.enqueue("a", "a.png")
+    queue.max_attempts = 2
+    await queue.claim("worker-1")
+
+    assert await queue.fail("a", "worker-1", "out of memory")
+    assert (await queue.claim("worker-2"))["attempt"] == 2
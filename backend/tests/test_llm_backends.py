@@ -0,0 +1,107 @@
+import threading
+
+import pytest
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+
+from models.llm_backends import TransformersBackend
+
+CORPUS = [
+    "Blood Cell Differential Count: neutrophils lymphocytes monocytes eosinophils basophils",
+    "Platelets and red blood cells are within the normal range for this patient.",
+    "Question: what does a high lymphocyte count mean? Answer: it may indicate an infection.",
+]
+
+@pytest.fixture(scope="module")
+def backend(tmp_path_factory):
+    """Transformers backend over a tiny randomly initialized causal LM"""
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+
+    path = tmp_path_factory.mktemp("tiny_lm")
+    tokenizer = Tokenizer(models.BPE(unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    tokenizer.train_from_iterator(CORPUS * 10, trainers.BpeTrainer(
+        vocab_size=400, special_tokens=["<s>", "</s>", "<unk>", "<pad>"],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet()
+    ))
+    fast = transformers.PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, bos_token="<s>", eos_token="</s>", unk_token="<unk>", pad_token="<pad>"
+    )
+    fast.save_pretrained(path)
+
+    torch.manual_seed(0)
+    config = transformers.GPT2Config(
+        vocab_size=len(fast), n_embd=32, n_layer=2, n_head=2, n_positions=256,
+        bos_token_id=0, eos_token_id=1, pad_token_id=3
+    )
+    transformers.GPT2LMHeadModel(config).save_pretrained(path)
+
+    backend = TransformersBackend(str(path))
+    backend.load()
+    return backend
+
+def test_generation_stops_once_the_event_is_set(backend):
+    prompt = CORPUS[0]
+    inputs = backend._prepare([prompt])
+    prompt_length = inputs["input_ids"].shape[1]
+
+    full = backend._generate_ids(backend._prepare([prompt]), 20)
+    stop = threading.Event()
+    stop.set()
+    stopped = backend._generate_ids(inputs, 20, stop=stop)
+
+    assert full.shape[1] - prompt_length == 20
+    assert stopped.shape[1] - prompt_length == 1
+
+def test_stream_passes_the_stop_event_to_generation(backend):
+    pieces = []
+    stop = threading.Event()
+
+    def on_text(text):
+        pieces.append(text)
+        stop.set()
+
+    backend.stream(CORPUS[0], 20, 0.0, on_text, stop=stop)
+    unstopped = []
+    backend.stream(CORPUS[0], 20, 0.0, unstopped.append)
+
+    assert len("".join(pieces)) < len("".join(unstopped))
+
+PREFIX = "Blood Cell Differential Count:\n\n"
+
+@pytest.fixture
+def uncached(backend):
+    """Greedy generation with no cached prefixes"""
+    def generate(prompts, max_new_tokens=12):
+        saved, backend._prefixes = backend._prefixes, {}
+        try:
+            return [backend.generate_batch([prompt], max_new_tokens, 0.0)[0] for prompt in prompts]
+        finally:
+            backend._prefixes = saved
+    yield generate
+    backend._prefixes.clear()
+
+def test_cached_prefix_generation_equals_uncached(backend, uncached):
+    prompts = [PREFIX + "neutrophils lymphocytes", PREFIX + "Platelets and red blood cells are within the normal range"]
+    expected = uncached(prompts)
+    assert all(expected)
+
+    assert backend.cache_prefix(PREFIX) > 0
+    assert [backend.generate_batch([prompt], 12, 0.0)[0] for prompt in prompts] == expected
+    # Suffixes of different lengths are padded between prefix and suffix in one batch
+    assert backend.generate_batch(prompts, 12, 0.0) == expected
+
+def test_extended_session_state_generation_equals_uncached(backend, uncached):
+    context = PREFIX + "Question: what does a high lymphocyte count mean?\n\n"
+    extended = context + "Answer: it may indicate an infection.\n\n"
+    prompt = extended + "Question: and monocytes?"
+    expected = uncached([prompt])
+    assert all(expected)
+
+    state = backend.encode_prefix(context)
+    state = backend.encode_prefix(extended, base=state)
+
+    assert state.text == extended
+    assert backend.generate_batch([prompt], 12, 0.0, prefix=state) == expected
@@ -0,0 +1,78 @@
+import asyncio
+import time
+
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from models.medical_llama import MedicalLLaMA
+
+RESULTS = {"cell_counts": {"neutrophils": 60}, "diseases": [], "abnormalities": []}
+
+class EndlessBackend:
+    """Streams one piece every few milliseconds until told to stop"""
+
+    def __init__(self):
+        self.pieces = 0
+        self.stopped = False
+
+    def stream(self, prompt, max_new_tokens, temperature, on_text, stop=None):
+        for _ in range(max_new_tokens):
+            if stop is not None and stop.is_set():
+                self.stopped = True
+                return
+            self.pieces += 1
+            on_text("token ")
+            time.sleep(0.005)
+
+@pytest.fixture
+def llama():
+    llama = MedicalLLaMA()
+    llama.generator = EndlessBackend()
+    llama._loaded.set()
+    yield llama
+    llama._executor.shutdown(wait=True)
+
+@pytest.mark.asyncio
+async def test_closing_the_stream_stops_generation(llama):
+    stream = llama.stream_explanation(RESULTS)
+    assert await stream.__anext__() == "token "
+    await stream.aclose()
+
+    llama._executor.shutdown(wait=True)
+    assert llama.generator.stopped
+    assert llama.generator.pieces < 512
+
+@pytest.mark.asyncio
+async def test_cancelling_the_consumer_stops_generation(llama):
+    async def consume():
+        async for _ in llama.stream_explanation(RESULTS):
+            pass
+
+    task = asyncio.create_task(consume())
+    await asyncio.sleep(0.05)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+    llama._executor.shutdown(wait=True)
+    assert llama.generator.stopped
+
+def turns(count):
+    return [{"question": f"question {i}", "answer": f"answer {i}"} for i in range(count)]
+
+@pytest.mark.parametrize("follow_up_turns", [1, 2, 3])
+def test_follow_up_context_grows_until_the_window_is_full(llama, follow_up_turns):
+    llama.follow_up_turns = follow_up_turns
+    contexts = [llama._follow_up_context(RESULTS, turns(count)) for count in range(1, 10)]
+
+    for count, (previous, context) in enumerate(zip(contexts, contexts[1:]), start=2):
+        kept = context.count("Patient Question:")
+        assert 1 <= kept <= follow_up_turns
+        assert f"question {count - 1}" in context
+        # Between re-anchors the new context extends the previous one, so the session is reused
+        if (count - 1) % follow_up_turns:
+            assert context.startswith(previous)
+        else:
+            assert kept == 1
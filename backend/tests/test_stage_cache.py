@@ -0,0 +1,69 @@
+import cv2
+import numpy as np
+import pytest
+
+from services.image_processor import ImageProcessor
+from services.stage_cache import StageCache
+
+from test_image_processor import smear
+
+@pytest.fixture
+def image_path(tmp_path):
+    path = tmp_path / "smear.png"
+    cv2.imwrite(str(path), smear(800, 600))
+    return str(path)
+
+def preprocess(image_path, stage_cache=None, **options):
+    processor = ImageProcessor(max_workers=1, stage_cache=stage_cache, **options)
+    try:
+        return processor._preprocess_sync(image_path, "hash" if stage_cache else None)
+    finally:
+        # Also finishes the stage cache's queued writes
+        processor.shutdown()
+
+def cached_files(cache_dir):
+    return sorted(cache_dir.glob("*/*.png"), key=lambda path: path.stat().st_mtime)
+
+@pytest.mark.parametrize("mode", ["classic", "fused"])
+@pytest.mark.parametrize("denoise_mode", ["bilateral", "auto"])
+def test_resumed_preprocessing_equals_uncached(tmp_path, image_path, mode, denoise_mode):
+    options = {"preprocess_mode": mode, "denoise_mode": denoise_mode}
+    uncached = preprocess(image_path, **options)
+    cache_dir = tmp_path / "stages"
+
+    first = preprocess(image_path, StageCache(str(cache_dir)), **options)
+    np.testing.assert_array_equal(first, uncached)
+
+    # Every stage output is stored; resume after each one by dropping the deeper ones
+    stored = cached_files(cache_dir)
+    assert len(stored) == (4 if mode == "classic" else 2)
+    for depth in range(len(stored), 0, -1):
+        for path in cached_files(cache_dir)[depth:]:
+            path.unlink()
+        resumed = preprocess(image_path, StageCache(str(cache_dir)), **options)
+        np.testing.assert_array_equal(resumed, uncached)
+
+def test_changed_denoising_resumes_from_enhanced_image(tmp_path, image_path):
+    cache_dir = tmp_path / "stages"
+    preprocess(image_path, StageCache(str(cache_dir)), denoise_mode="bilateral")
+
+    cache = StageCache(str(cache_dir))
+    resumed = preprocess(image_path, cache, denoise_mode="fast")
+
+    assert cache.hits == 1
+    np.testing.assert_array_equal(resumed, preprocess(image_path, denoise_mode="fast"))
+
+def test_resumed_auto_denoising_reuses_cached_noise_estimate(tmp_path, image_path, monkeypatch):
+    cache_dir = tmp_path / "stages"
+    uncached = preprocess(image_path, denoise_mode="auto")
+    preprocess(image_path, StageCache(str(cache_dir)), denoise_mode="auto")
+    assert len(list(cache_dir.glob("*/*.json"))) == 1
+
+    # Only the denoised image is missing, so nothing needs the decoded image
+    cached_files(cache_dir)[-1].unlink()
+    def no_load(self, image_path):
+        raise AssertionError("image decoded on resume")
+    monkeypatch.setattr(ImageProcessor, "load_image", no_load)
+
+    resumed = preprocess(image_path, StageCache(str(cache_dir)), denoise_mode="auto")
+    np.testing.assert_array_equal(resumed, uncached)
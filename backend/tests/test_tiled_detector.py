@@ -0,0 +1,154 @@
+import cv2
+import numpy as np
+import pytest
+
+from services.image_processor import ImageProcessor, ImageTile, _tile_spans
+from services.tiled_detector import TiledCellDetector
+
+class PassthroughProcessor:
+    def preprocess_tile(self, tile):
+        return tile
+
+class CellsAt:
+    """Stands in for the detector: finds every cell lying wholly inside the image it is given"""
+
+    detection_field = (1024, 1024)
+
+    def __init__(self, cells, radius):
+        self.cells = cells
+        self.radius = radius
+
+    def detect_cell_boxes(self, image, scale=1.0):
+        # Cell positions are encoded in the tile's first pixel as its global origin
+        origin_x, origin_y = int(image[0, 0, 0]) * 16, int(image[0, 0, 1]) * 16
+        height, width = image.shape[:2]
+        boxes = []
+        for x, y in self.cells:
+            x1, y1 = x - origin_x - self.radius, y - origin_y - self.radius
+            x2, y2 = x - origin_x + self.radius, y - origin_y + self.radius
+            if x1 >= 0 and y1 >= 0 and x2 <= width and y2 <= height:
+                boxes.append((x1, y1, x2, y2))
+        return np.array(boxes, dtype=np.int32).reshape(-1, 4)
+
+def tiles(width, height, tile_size, overlap):
+    for y, core_y0, core_y1 in _tile_spans(height, tile_size, overlap):
+        for x, core_x0, core_x1 in _tile_spans(width, tile_size, overlap):
+            image = np.zeros((min(tile_size, height - y), min(tile_size, width - x), 3), dtype=np.uint8)
+            image[0, 0, :2] = (x // 16, y // 16)
+            yield ImageTile(x, y, image, (core_x0, core_y0, core_x1, core_y1))
+
+def test_cells_in_tile_overlaps_are_kept_once():
+    width, height, tile_size, overlap, radius = 2000, 1500, 512, 128, 20
+
+    # Cells straddling every seam, in the overlaps and at their corners
+    seams_x = [start for start, _, _ in _tile_spans(width, tile_size, overlap)][1:]
+    seams_y = [start for start, _, _ in _tile_spans(height, tile_size, overlap)][1:]
+    cells = [(x + offset, y + offset) for x in seams_x for y in seams_y for offset in (32, 64, 96)]
+    cells += [(x + 64, 300) for x in seams_x] + [(300, y + 64) for y in seams_y]
+
+    detector = TiledCellDetector(PassthroughProcessor(), CellsAt(cells, radius), max_workers=1)
+    found = [region for tile in tiles(width, height, tile_size, overlap) for region in detector._process_tile(tile)]
+    detector.shutdown()
+
+    assert len(found) == len(cells)
+
+def test_canvas_scale_maps_full_resolution_to_the_canvas():
+    processor = ImageProcessor(max_workers=1)
+    try:
+        assert processor.canvas_scale(4096, 3072) == 4.0
+        assert processor.canvas_scale(1024, 512) == 1.0
+    finally:
+        processor.shutdown()
+
+def known_smear(width, height, seed=0):
+    """Cells and platelets on a jittered grid, with every third slot a platelet.
+
+    Sizes are those of a smear filling the analysis canvas at this resolution.
+    Returns the image and the (x, y, radius, is_platelet) of each object.
+    """
+    rng = np.random.default_rng(seed)
+    scale = max(width, height) / 1024
+    image = np.full((height, width, 3), (205, 190, 225), dtype=np.uint8)
+    objects = []
+    pitch = int(80 * scale)
+    for row, y in enumerate(range(pitch // 2, height - pitch // 2, pitch)):
+        for column, x in enumerate(range(pitch // 2, width - pitch // 2, pitch)):
+            platelet = (row + column) % 3 == 0
+            radius = int((13 if platelet else 24) * scale * rng.uniform(0.9, 1.1))
+            x, y = (int(v) for v in np.array([x, y]) + rng.integers(int(-8 * scale), int(8 * scale) + 1, 2))
+            cv2.circle(image, (x, y), radius, (120, 60, 140) if platelet else (150, 110, 190), -1)
+            objects.append((x, y, radius, platelet))
+    image = cv2.GaussianBlur(image, (5, 5), 0)
+    return np.clip(image + rng.normal(0, 3, image.shape), 0, 255).astype(np.uint8), objects
+
+def found(objects, boxes):
+    """(cells, platelets) with a box centred on them"""
+    centre_x, centre_y = (boxes[:, 0] + boxes[:, 2]) / 2, (boxes[:, 1] + boxes[:, 3]) / 2
+    counts = [0, 0]
+    for x, y, radius, platelet in objects:
+        counts[platelet] += bool(((centre_x - x) ** 2 + (centre_y - y) ** 2 < (radius / 2) ** 2).any())
+    return tuple(counts)
+
+@pytest.fixture
+def cell_detector():
+    efficientnet_model = pytest.importorskip("models.efficientnet_model")
+    return efficientnet_model.EfficientNetB0Model()
+
+def resized_boxes(processor, detector, image):
+    """Boxes the resized path finds, mapped back to image coordinates"""
+    boxes = detector.detect_cell_boxes(processor.run_pipeline(image)).astype(np.float64)
+    height, width = image.shape[:2]
+    scale = processor.canvas_scale(width, height)
+    canvas_width, canvas_height = processor.target_size
+    boxes[:, 0::2] -= (canvas_width - int(width / scale)) // 2
+    boxes[:, 1::2] -= (canvas_height - int(height / scale)) // 2
+    return boxes * scale
+
+def tiled_boxes(processor, detector, image_path):
+    """Boxes the tiled path keeps, in image coordinates"""
+    tiled = TiledCellDetector(processor, detector, max_workers=1)
+    boxes = []
+    with processor.open_image(image_path) as source:
+        scale = processor.canvas_scale(source.width, source.height)
+        for tile in processor.iter_tiles(source):
+            owned = tiled._owned_boxes(tile, processor.preprocess_tile(tile.image), scale)
+            boxes.append(owned + [tile.x, tile.y, tile.x, tile.y])
+    tiled.shutdown()
+    return np.concatenate(boxes)
+
+def test_tiled_path_finds_the_cells_and_platelets_the_resized_path_finds(tmp_path, cell_detector):
+    image, objects = known_smear(4096, 3072)
+    image_path = tmp_path / "smear.png"
+    cv2.imwrite(str(image_path), image)
+
+    processor = ImageProcessor(max_workers=1)
+    try:
+        resized = found(objects, resized_boxes(processor, cell_detector, image))
+        tiled = found(objects, tiled_boxes(processor, cell_detector, str(image_path)))
+    finally:
+        processor.shutdown()
+
+    cells, platelets = sum(not platelet for *_, platelet in objects), sum(platelet for *_, platelet in objects)
+    assert tiled[0] >= resized[0] and tiled[0] >= 0.9 * cells
+    assert tiled[1] >= resized[1] and tiled[1] >= 0.5 * platelets
+
+def test_counts_agree_either_side_of_the_tiling_threshold(tmp_path, cell_detector):
+    processor = ImageProcessor(max_workers=1, tiled_min_side=2048)
+    detector = TiledCellDetector(processor, cell_detector, max_workers=2)
+    densities = {}
+    try:
+        for width, height in [(2040, 1530), (2048, 1536)]:
+            image_path = str(tmp_path / f"smear_{width}.png")
+            cv2.imwrite(image_path, known_smear(width, height)[0])
+
+            if processor.use_tiled_analysis(image_path):
+                regions, fields = detector._detect_sync(image_path)
+                densities["tiled"] = len(regions) / fields
+            else:
+                boxes = cell_detector.detect_cell_boxes(processor.run_pipeline(processor.load_image(image_path)))
+                densities["resized"] = len(boxes) / processor.image_fields(image_path)
+    finally:
+        detector.shutdown()
+        processor.shutdown()
+
+    assert densities["tiled"] == pytest.approx(densities["resized"], rel=0.1)
@@ -0,0 +1,57 @@
+import pytest
+from fastapi import FastAPI, File, UploadFile
+from fastapi.testclient import TestClient
+
+from services.upload_limit import RequestSizeLimit
+
+LIMIT = 4096
+
+@pytest.fixture
+def client():
+    app = FastAPI()
+    app.add_middleware(RequestSizeLimit, max_bytes=LIMIT, paths=["/upload"])
+    app.state.calls = 0
+
+    @app.post("/upload")
+    async def upload(file: UploadFile = File(...)):
+        app.state.calls += 1
+        return {"size": len(await file.read())}
+
+    @app.post("/other")
+    async def other(file: UploadFile = File(...)):
+        return {"size": len(await file.read())}
+
+    with TestClient(app) as client:
+        yield client
+
+def test_upload_within_limit_is_accepted(client):
+    response = client.post("/upload", files={"file": ("a.png", b"x" * 1000, "image/png")})
+
+    assert response.status_code == 200
+    assert response.json() == {"size": 1000}
+
+def test_declared_oversized_body_is_rejected_before_parsing(client):
+    response = client.post("/upload", files={"file": ("a.png", b"x" * (LIMIT * 2), "image/png")})
+
+    assert response.status_code == 413
+    assert client.app.state.calls == 0
+
+def test_undeclared_oversized_body_is_rejected_while_streaming(client):
+    boundary = "limit-test"
+    body = (f"--{boundary}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"a.png\"\r\n"
+            f"Content-Type: image/png\r\n\r\n").encode() + b"x" * (LIMIT * 2) + f"\r\n--{boundary}--\r\n".encode()
+
+    def chunks():
+        for start in range(0, len(body), 1024):
+            yield body[start:start + 1024]
+
+    response = client.post("/upload", content=chunks(),
+                           headers={"content-type": f"multipart/form-data; boundary={boundary}"})
+
+    assert response.status_code == 413
+    assert client.app.state.calls == 0
+
+def test_other_paths_are_not_limited(client):
+    response = client.post("/other", files={"file": ("a.png", b"x" * (LIMIT * 2), "image/png")})
+
+    assert response.status_code == 200
@@ -0,0 +1,35 @@
+import asyncio
+import time
+
+import pytest
+
+from services.worker_pool import AnalysisWorkerPool
+
+def idle_worker(worker_id, events, stop, jobs_per_worker, config):
+    """Stands in for the analysis worker: ready at once, then polls for the stop like it"""
+    events.put(("ready", worker_id, None))
+    while not stop.is_set():
+        time.sleep(0.05)
+
+async def wait_until(condition, timeout=30.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline, "timed out"
+        await asyncio.sleep(0.01)
+
+@pytest.mark.asyncio
+async def test_killed_worker_is_respawned():
+    pool = AnalysisWorkerPool(num_workers=2, respawn_backoff=0.2, monitor_interval=0.05)
+    pool._worker_main = idle_worker
+    pool.start()
+    try:
+        await wait_until(lambda: pool.ready_workers == {0, 1})
+        killed = pool._processes[0]
+        killed.kill()
+
+        await wait_until(lambda: pool.ready_workers == {1})
+        await wait_until(lambda: pool.ready_workers == {0, 1})
+        assert pool._processes[0].pid != killed.pid
+        assert pool._crashes == {}
+    finally:
+        await asyncio.to_thread(pool.stop, 5.0)